@@ -121,20 +121,72 @@ This is how the artifact_path is returned. This hook can be removed, by running
 ``unregister_hook_callback`` with the name of the hook callback.
 
 """
+import atexit
+import base64
 import logging
 import os
+import queue
 import re
 import sys
+import threading
+import time
+import uuid
+import weakref
+from functools import partial
 from pathlib import Path
 
+import zmq
+from iqe.artifactor import wire
+from iqe.artifactor.dispatch import LaneDispatcher
+from iqe.artifactor.journal import Journal
+from iqe.artifactor.stats import callback_name
+from iqe.artifactor.stats import DispatchStats
+from iqe.artifactor.store import ArtifactStore
+from iqe.artifactor.store import plain_artifacts
 from iqe.artifactor.utils import _random_port
 from riggerlib import Rigger
 from riggerlib import RiggerBasePlugin
 from riggerlib import RiggerClient
+from riggerlib.task import Task
+
+# Name of the internal event that carries a batch of coalesced client events
+BATCH_HOOK = "artifactor_batch"
+# Key under which events sent through the request/reply socket name the last one-way event
+# fired before them
+ONEWAY_BARRIER = "_oneway_barrier"
+# Seconds an event is held back for the one-way events it waits for before it runs anyway
+ONEWAY_TIMEOUT = 2.0
+# Hooks carrying log records, they are not journaled
+LOG_HOOKS = frozenset({"log_message", "log_messages"})
+# Name of the internal event returning the dispatch stats of the server
+STATS_HOOK = "artifactor_stats"
+# Key under which the server stamps the time an event was queued at
+QUEUED_AT = "_queued_at"
 
 
 class Artifactor(Rigger):
-    """A sub from Rigger"""
+    """A sub from Rigger
+
+    By default events are processed one after the other. If ``dispatch_workers`` is set in the
+    config, events carrying a ``slaveid`` are run on a pool of that many threads instead,
+    in order for each slave and concurrently across slaves. Events without a ``slaveid``
+    (``start_session``, ``build_report``, ``finish_session``, ...) wait for all running
+    events to finish and run on their own, so they always see a consistent ``artifacts``.
+    Concurrent events only touch the entries of their own tests, and their global updates are
+    merged under the global data lock.
+
+    If ``journal`` is set in the config, the session is journaled to ``artifactor.journal``
+    in the log dir, see ``iqe.artifactor.journal``. The log hooks are not journaled, they do
+    not go into the report.
+
+    The time events wait in the queue, the time spent in every callback and plugin hook and the
+    sizes of one-way messages are recorded in ``stats``. Clients can fire ``artifactor_stats``
+    to get a summary, it is also written to ``artifactor.log`` after ``finish_session``.
+    """
+
+    _dispatcher = None
+    journal = None
+    stats = None
 
     def set_config(self, config):
         self.config = config
@@ -143,6 +195,7 @@ class Artifactor(Rigger):
         """
         Reads the config data and sets up values
         """
+        self.stats = DispatchStats()
         if not self.config:
             return False
         self.log_dir = Path(self.config.get("log_dir", None))
@@ -158,16 +211,230 @@ class Artifactor(Rigger):
             print("!!! Artifact dir must be specified in yaml")
             sys.exit(127)
         self.config["zmq_socket_address"] = "tcp://127.0.0.1:{}".format(_random_port())
+        self.config["zmq_oneway_address"] = "tcp://127.0.0.1:{}".format(_random_port())
         self.setup_plugin_instances()
+        if self.config.get("dispatch_workers"):
+            self._dispatcher = LaneDispatcher(self.config["dispatch_workers"])
+        self._oneway_seen = {}
+        # the events held back for one-way events, as (sender, seq, deadline, tid)
+        self._oneway_held = []
+        self._oneway_lock = threading.Lock()
         self.start_server()
+        self.start_oneway_server()
         self.global_data = {
             "artifactor_config": self.config,
             "log_dir": str(self.log_dir),
             "artifact_dir": str(self.artifact_dir),
-            "artifacts": dict(),
+            "artifacts": ArtifactStore(),
             "old_artifacts": dict(),
             "per_run": self.config.get("per_run"),
         }
+        if self.config.get("journal"):
+            self.journal = Journal(
+                str(self.log_dir / "artifactor.journal"),
+                on_error=lambda e: self.log_message(f"not journaled: {e!r}"),
+            )
+            self.journal.append(
+                "session",
+                {key: self.global_data[key] for key in ("log_dir", "artifact_dir", "per_run")},
+            )
+            self.global_data["artifacts"].journal = self.journal
+
+    def process_queue(self):
+        """
+        Takes the events off the global queue and runs them, either right away or, with
+        ``dispatch_workers`` configured, in the lane of their slave
+        """
+        while not self._global_queue_shutdown:
+            while not self._global_queue.empty():
+                with self._queue_lock:
+                    tid = self._global_queue.get()
+                    task = self._task_list[tid]
+                    task.status = Task.RUNNING
+                lane = event_lane(task.json_dict)
+                if self._dispatcher is None:
+                    self.run_task(tid)
+                elif lane is None:
+                    self._dispatcher.join()
+                    self.run_task(tid)
+                else:
+                    self._dispatcher.submit(lane, partial(self.run_task, tid))
+            time.sleep(0.1)
+
+    def run_task(self, tid):
+        task = self._task_list[tid]
+        obj = task.json_dict
+        queued_at = obj.pop(QUEUED_AT, None)
+        if queued_at is not None:
+            self.stats.queue_wait.observe(time.monotonic() - queued_at, obj["hook_name"])
+        try:
+            loc, glo = self.process_hook(obj["hook_name"], **obj["data"])
+            if obj.get("grab_result", None):
+                combined_dict = {}
+                combined_dict.update(glo)
+                combined_dict.update(loc)
+                # the records are no json, they are sent back as the dicts they replace
+                for key in ("artifacts", "old_artifacts"):
+                    if key in combined_dict:
+                        combined_dict[key] = plain_artifacts(combined_dict[key])
+                task.output = combined_dict
+        except Exception as e:
+            self.log_message(e)
+        with self._queue_lock:
+            self._global_queue.task_done()
+            task.status = Task.FINISHED
+        if not obj.get("grab_result", None):
+            del self._task_list[tid]
+
+    def stop_server(self):
+        try:
+            super().stop_server()
+        finally:
+            if self._dispatcher is not None:
+                self._dispatcher.shutdown()
+            if self.journal is not None:
+                self.journal.close()
+
+    def start_oneway_server(self):
+        """
+        Starts the thread receiving events from the one-way channel at ``zmq_oneway_address``
+        """
+        oeh = threading.Thread(
+            target=self.oneway_event_handler,
+            args=(self.config["zmq_oneway_address"],),
+            name="zmq_oneway_event_handler",
+        )
+        oeh.daemon = True
+        oeh.start()
+
+    def oneway_event_handler(self, zmq_socket_address):
+        """
+        Receives the events clients send without waiting for a reply and queues them like
+        the ones coming in through the request/reply socket
+        """
+        zmq_socket = zmq.Context.instance().socket(zmq.PULL)
+        zmq_socket.set(zmq.RCVTIMEO, 300)
+        zmq_socket.bind(zmq_socket_address)
+
+        while not self._zmq_event_handler_shutdown:
+            try:
+                frames = zmq_socket.recv_multipart(copy=False)
+            except zmq.Again:
+                self.release_held()
+                continue
+            self.stats.message_bytes.observe(sum(len(frame) for frame in frames), "oneway")
+            try:
+                json_dict = wire.decode(frames)
+            except Exception as e:
+                self.log_message(e)
+                continue
+            self._fire_internal_hook(json_dict)
+            with self._oneway_lock:
+                self._oneway_seen[json_dict["sender"]] = json_dict["seq"]
+            self.release_held()
+
+        zmq_socket.close()
+
+    def _fire_internal_hook(self, json_dict):
+        barrier = json_dict.get("data", {}).pop(ONEWAY_BARRIER, None)
+        json_dict[QUEUED_AT] = time.monotonic()
+        if barrier is None or not self._global_queue:
+            return super()._fire_internal_hook(json_dict)
+        sender, seq = barrier
+        task = Task(json_dict)
+        tid = task.tid.hexdigest()
+        self._task_list[tid] = task
+        with self._oneway_lock:
+            if self._oneway_seen.get(sender, 0) < seq:
+                # queued by release_held once the one-way events before it are, the client
+                # gets its reply right away
+                self._oneway_held.append((sender, seq, time.monotonic() + ONEWAY_TIMEOUT, tid))
+                return tid
+            with self._queue_lock:
+                self._global_queue.put(tid)
+        return tid
+
+    def release_held(self):
+        """
+        Queues the events held back for one-way events that got queued by now, so an event
+        sent through the request/reply socket never overtakes the one-way events fired before
+        it. Events still waiting after ``ONEWAY_TIMEOUT`` seconds are queued anyway.
+        """
+        if not self._oneway_held:
+            return
+        now = time.monotonic()
+        late = []
+        with self._oneway_lock:
+            held = []
+            for sender, seq, deadline, tid in self._oneway_held:
+                if self._oneway_seen.get(sender, 0) >= seq or deadline <= now:
+                    if self._oneway_seen.get(sender, 0) < seq:
+                        late.append((sender, seq))
+                    with self._queue_lock:
+                        self._global_queue.put(tid)
+                else:
+                    held.append((sender, seq, deadline, tid))
+            self._oneway_held = held
+        for sender, seq in late:
+            self.log_message(f"one-way events of {sender} up to {seq} did not arrive in time")
+
+    def process_hook(self, hook_name, **kwargs):
+        if hook_name == BATCH_HOOK:
+            return self.process_batch(**kwargs)
+        with self.stats.event(hook_name):
+            if self.journal is None or hook_name in LOG_HOOKS:
+                return super().process_hook(hook_name, **kwargs)
+            self.journal.append(
+                "hook", hook_name, {k: v for k, v in kwargs.items() if k not in wire.PAYLOAD_ARGS}
+            )
+            result = super().process_hook(hook_name, **kwargs)
+            if hook_name == "finish_session":
+                self.journal.sync()
+            return result
+
+    def handle_results(self, call, args, kwargs):
+        with self.stats.timed(self.stats.callbacks, self.stats.current_event, callback_name(call)):
+            return super().handle_results(call, args, kwargs)
+
+    def handle_collects(self, result, loc_collect, glo_collect):
+        with self.stats.timed(self.stats.merges, self.stats.current_event):
+            return self._handle_collects(result, loc_collect, glo_collect)
+
+    def _handle_collects(self, result, loc_collect, glo_collect):
+        if (
+            self.journal is not None
+            and result
+            and (result[0] or result[1])
+            and self.stats.current_event not in LOG_HOOKS
+        ):
+            # skip local updates that merely pass on global data, like merge_artifacts does
+            local_updates = {
+                k: v for k, v in (result[0] or {}).items() if k not in self.global_data
+            }
+            self.journal.append("update", local_updates, result[1] or {})
+        return super().handle_collects(result, loc_collect, glo_collect)
+
+    def process_batch(self, events, **kwargs):
+        """
+        Dispatches the events of a batch sent by an ``ArtifactorClient`` in the order they
+        were fired on the client
+        """
+        if not self.initialized:
+            return
+        for event in events:
+            try:
+                self.process_hook(event["hook_name"], **event["data"])
+            except Exception as e:
+                # one broken event must not drop the rest of the batch
+                self.log_message(e)
+        return {}, self.global_data
+
+    def stats_summary(self):
+        """Pre hook callback of ``artifactor_stats``, returns the summary of the stats"""
+        return {"stats": self.stats.summary()}, None
+
+    def log_stats(self):
+        self.logger.info(self.stats.format_summary())
 
     def handle_failure(self, exc):
         self.logger.error("exception", exc_info=exc)
@@ -176,8 +443,267 @@ class Artifactor(Rigger):
         self.logger.debug(message)
 
 
+def event_lane(json_dict):
+    """Returns the slaveid an event is dispatched in order with, None for session wide events"""
+    data = json_dict["data"]
+    if json_dict["hook_name"] == BATCH_HOOK:
+        slaveids = {event["data"].get("slaveid") for event in data["events"]}
+        return slaveids.pop() if len(slaveids) == 1 else None
+    return data.get("slaveid")
+
+
+# Clients that still buffer events, flushed when the interpreter exits
+_batching_clients = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_batches():
+    for client in list(_batching_clients):
+        client.flush()
+
+
+def _base64_payloads(data):
+    """Makes binary payloads of hook data fit for the json request/reply socket"""
+    for key in wire.PAYLOAD_ARGS:
+        if isinstance(data.get(key), wire.BINARY):
+            data[key] = base64.b64encode(data[key]).decode("ascii")
+            data["contents_base64"] = True
+
+
 class ArtifactorClient(RiggerClient):
-    pass
+    """A sub from RiggerClient
+
+    If ``batch_size`` is set, hooks that need no result are not sent one by one, but buffered
+    and sent as a single batch event. The buffer is flushed when it holds ``batch_size`` events,
+    when one of ``flush_hooks`` is fired, or explicitly by ``flush()``. A daemon thread flushes
+    it once its oldest event is ``batch_age`` seconds old, so events are not held back when
+    nothing is fired anymore, and it is flushed when the interpreter exits. Hooks that grab a
+    result or wait for their task flush the buffer first, so the server always sees the events
+    in the order they were fired.
+
+    If ``oneway_address`` is set (the ``zmq_oneway_address`` of the server config), hooks
+    fired with ``oneway=True``, or named in ``oneway_hooks``, are pushed to the server without
+    waiting for a reply. Events sent through the request/reply socket afterwards carry the
+    sequence number of the last pushed event, and the server holds them back until that one
+    arrived. The sequence numbers are kept per client, the server tells clients apart by
+    ``sender`` followed by an id of the client, workers should pass their slaveid as ``sender``
+    to make them easy to tell apart in the log.
+    On the one-way channel binary ``contents`` travel as raw frames next to a header encoded
+    with ``serializer`` (see ``iqe.artifactor.wire``), on the request/reply socket they are
+    sent base64 encoded.
+
+    If ``filter_logs`` is set, ``log_message`` and ``log_messages`` records below the level
+    the logger plugin logs them at are dropped before they are sent. Set it only if the server
+    has the logger plugin configured, as other plugins hooking the log events would miss the
+    records. The level is queried through the ``log_level`` hook and refreshed every
+    ``log_level_ttl`` seconds, on a daemon thread with its own socket, so logging never waits
+    for the server.
+    """
+
+    flush_hooks = frozenset({"finish_test", "build_report", "finish_session"})
+    oneway_hooks = frozenset(
+        {
+            "log_message",
+            "log_messages",
+            "report_test",
+            "filedump",
+            "filedump_open",
+            "filedump_chunk",
+            "filedump_close",
+        }
+    )
+
+    def __init__(
+        self,
+        address,
+        port,
+        batch_size=None,
+        batch_age=1.0,
+        oneway_address=None,
+        oneway_hooks=None,
+        sender=None,
+        serializer=None,
+        filter_logs=False,
+        log_level_ttl=30.0,
+    ):
+        super().__init__(address, port)
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.oneway_address = oneway_address
+        if oneway_hooks is not None:
+            self.oneway_hooks = frozenset(oneway_hooks)
+        # unique per client, a restarted worker starts its sequence numbers over
+        self.sender = "{}-{}".format(sender, uuid.uuid4().hex) if sender else uuid.uuid4().hex
+        self.serializer = serializer or wire.default_serializer()
+        self.filter_logs = filter_logs
+        self.log_level_ttl = log_level_ttl
+        self._log_levels = {}
+        self._log_level_queries = queue.Queue()
+        self._log_level_thread = None
+        self._batch = []
+        self._batch_started = None
+        self._batch_oneway = True
+        self._oneway_seq = 0
+        self._oneway_socket = None
+        self._lock = threading.RLock()
+        # notified when an event starts a batch, the flusher waits for it to get old
+        self._batch_due = threading.Condition(self._lock)
+        self._flusher = None
+        self._closed = False
+
+    def fire_hook(self, hook_name, grab_result=False, wait_for_task=False, oneway=None, **kwargs):
+        if self.filter_logs and hook_name in ("log_message", "log_messages"):
+            level = self.log_level(kwargs.get("slaveid"))
+            if hook_name == "log_message":
+                if kwargs["log_record"].get("levelno", level) < level:
+                    return None
+            else:
+                kwargs["log_records"] = [
+                    record
+                    for record in kwargs["log_records"]
+                    if record.get("levelno", level) >= level
+                ]
+                if not kwargs["log_records"]:
+                    return None
+        if grab_result or wait_for_task:
+            oneway = False
+        elif oneway is None:
+            oneway = hook_name in self.oneway_hooks
+        if not self.batch_size or grab_result or wait_for_task:
+            with self._lock:
+                self.flush()
+                return self._send(hook_name, kwargs, oneway, grab_result, wait_for_task)
+        with self._lock:
+            if not self._batch:
+                self._batch_started = time.monotonic()
+                self._start_flusher()
+                self._batch_due.notify()
+            self._batch.append({"hook_name": hook_name, "data": kwargs})
+            self._batch_oneway = self._batch_oneway and oneway
+            if len(self._batch) >= self.batch_size or hook_name in self.flush_hooks:
+                self.flush()
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            _batching_clients.add(self)
+            self._flusher = threading.Thread(
+                target=self._flush_aged, name="artifactor_batch_flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_aged(self):
+        """Flushes the buffer once its oldest event is ``batch_age`` seconds old"""
+        with self._batch_due:
+            while not self._closed:
+                if not self._batch:
+                    self._batch_due.wait()
+                    continue
+                remaining = self._batch_started + self.batch_age - time.monotonic()
+                if remaining > 0:
+                    self._batch_due.wait(remaining)
+                else:
+                    self.flush()
+
+    def log_level(self, slaveid=None):
+        """Returns the level the logger plugin logs the records of a slave at
+
+        Until the server answered, and if it has no logger plugin, every record passes. Once
+        the level is ``log_level_ttl`` seconds old it is refreshed in the background, the
+        level known so far is returned meanwhile.
+        """
+        cached = self._log_levels.get(slaveid)
+        if cached is None or time.monotonic() - cached[1] >= self.log_level_ttl:
+            # cache first, records logged while querying must not query again
+            self._log_levels[slaveid] = cached = (cached[0] if cached else 0, time.monotonic())
+            if self._log_level_thread is None:
+                self._log_level_thread = threading.Thread(
+                    target=self._query_log_levels, name="artifactor_log_level", daemon=True
+                )
+                self._log_level_thread.start()
+            self._log_level_queries.put(slaveid)
+        return cached[0]
+
+    def _query_log_levels(self):
+        """Queries the levels asked for by log_level, one after the other"""
+        while True:
+            slaveid = self._log_level_queries.get()
+            # the sockets of RiggerClient are per thread, this neither waits for the buffered
+            # events nor holds back the ones fired meanwhile
+            output = RiggerClient.fire_hook(self, "log_level", grab_result=True, slaveid=slaveid)
+            if output and "log_level" in output:
+                self._log_levels[slaveid] = (output["log_level"], time.monotonic())
+
+    def flush(self):
+        """Sends all buffered events to the server as one batch"""
+        with self._lock:
+            events, self._batch = self._batch, []
+            oneway, self._batch_oneway = self._batch_oneway, True
+            if events:
+                self._send(BATCH_HOOK, {"events": events}, oneway)
+
+    def filedump_stream(self, stream, chunk_size=1 << 20, window=4, **kwargs):
+        """Streams the contents of a file object to the filedump plugin in chunks
+
+        Only ``chunk_size`` of the contents are held in memory at any time. Every ``window``th
+        chunk waits until the server wrote it, so no more than ``window`` chunks are ever on
+        their way or queued on the server, however slow its disk is. ``kwargs`` are the
+        arguments of a ``filedump``, like description, file_type or slaveid.
+        """
+        handle = uuid.uuid4().hex
+        slaveid = kwargs.get("slaveid")
+        self.fire_hook("filedump_open", handle=handle, **kwargs)
+        sent = 0
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            sent += 1
+            # the chunks of a stream are written in order, once this one is written all
+            # the ones before it are too
+            self.fire_hook(
+                "filedump_chunk",
+                wait_for_task=not sent % window,
+                handle=handle,
+                contents=chunk,
+                slaveid=slaveid,
+            )
+            # never let chunks pile up in the batch
+            self.flush()
+        self.fire_hook("filedump_close", handle=handle, slaveid=slaveid)
+
+    def _send(self, hook_name, data, oneway=False, grab_result=False, wait_for_task=False):
+        if oneway and self.oneway_address:
+            self._push(hook_name, data)
+            return None
+        for event_data in [data] + [event["data"] for event in data.get("events", ())]:
+            _base64_payloads(event_data)
+        if self._oneway_seq:
+            data[ONEWAY_BARRIER] = [self.sender, self._oneway_seq]
+        return super().fire_hook(hook_name, grab_result, wait_for_task, **data)
+
+    def _push(self, hook_name, data):
+        if self._oneway_socket is None:
+            self._oneway_socket = zmq.Context.instance().socket(zmq.PUSH)
+            self._oneway_socket.connect(self.oneway_address)
+        self._oneway_seq += 1
+        message = {
+            "hook_name": hook_name,
+            "data": data,
+            "sender": self.sender,
+            "seq": self._oneway_seq,
+        }
+        self._oneway_socket.send_multipart(wire.encode(message, self.serializer), copy=False)
+
+    def terminate(self):
+        with self._lock:
+            self.flush()
+            self._closed = True
+            self._batch_due.notify()
+            _batching_clients.discard(self)
+            if self._oneway_socket is not None:
+                self._oneway_socket.close()
+                self._oneway_socket = None
+        return super().terminate()
 
 
 class ArtifactorBasePlugin(RiggerBasePlugin):
@@ -210,6 +736,12 @@ def initialize(artifactor):
     artifactor.register_hook_callback(
         "finish_session", "pre", merge_artifacts, name="merge_artifacts"
     )
+    artifactor.register_hook_callback(
+        STATS_HOOK, "pre", artifactor.stats_summary, name="artifactor_stats"
+    )
+    artifactor.register_hook_callback(
+        "finish_session", "post", artifactor.log_stats, name="artifactor_stats"
+    )
     artifactor.initialized = True
 
 
@@ -6,6 +6,8 @@ import yaml
 from iqe.artifactor import _random_port
 from iqe.artifactor import Artifactor
 from iqe.artifactor import initialize
+from iqe.artifactor import journal
+from iqe.artifactor import merge_artifacts
 from iqe.artifactor.plugins import filedump
 from iqe.artifactor.plugins import logger
 from iqe.artifactor.plugins import prometheus
@@ -37,12 +39,35 @@ def run(art_config, run_id=None):
     # log.logger.info('artifactor listening on port %d', art_config['server_port'])
 
 
+def replay(art_config, journal_file):
+    """Renders the report of a journaled session, without firing any hook"""
+    global_data = journal.replay_journal(journal_file)
+    merge_artifacts(global_data["old_artifacts"], global_data["artifacts"])
+
+    reporter_config = art_config.get("plugins", {}).get("reporter", {})
+    rep = reporter.Reporter("reporter", reporter_config, None)
+    rep.configure()
+    rep.run_report(
+        old_artifacts=global_data["old_artifacts"],
+        artifact_dir=global_data["artifact_dir"],
+        per_run=global_data["per_run"],
+        run_id=global_data.get("run_id"),
+        version=global_data.get("version"),
+        fw_version=global_data.get("fw_version"),
+    )
+
+
 @click.command(help="Starts an artifactor server manually")
 @click.option("--run-id", default=None)
 @click.option("--port", default=None)
 @click.option("--log-dir", default=None)
 @click.option("--config", default=None)
-def main(run_id, port, config, log_dir):
+@click.option(
+    "--replay-journal",
+    default=None,
+    help="Render the report from the journal of a previous session instead of serving",
+)
+def main(run_id, port, config, log_dir, replay_journal):
     """Main function for running artifactor server"""
     import sys
 
@@ -64,6 +89,11 @@ def main(run_id, port, config, log_dir):
         print("Log dir not declared on cli or in config, exiting.")
         sys.exit(127)
     art_config["log_dir"] = log_dir
+
+    if replay_journal:
+        replay(art_config, replay_journal)
+        return
+
     art_config["server_port"] = int(port)
 
     try:
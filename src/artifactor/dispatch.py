@@ -0,0 +1,49 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LaneDispatcher(object):
+    """Runs callables on a thread pool, strictly in order per lane and concurrently across lanes
+
+    Every lane has at most one callable running at any time. When it finishes, the next queued
+    callable of the same lane is handed to the pool, so a busy lane can not starve the others.
+
+    Args:
+        workers: The number of pool threads.
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="artifactor_dispatch")
+        self._idle = threading.Condition()
+        self._lanes = {}
+
+    def submit(self, lane, func):
+        """Queues ``func`` behind everything submitted to ``lane`` before"""
+        with self._idle:
+            if lane in self._lanes:
+                self._lanes[lane].append(func)
+                return
+            self._lanes[lane] = deque()
+        self._pool.submit(self._run, lane, func)
+
+    def _run(self, lane, func):
+        try:
+            func()
+        finally:
+            with self._idle:
+                pending = self._lanes[lane]
+                if pending:
+                    self._pool.submit(self._run, lane, pending.popleft())
+                else:
+                    del self._lanes[lane]
+                    self._idle.notify_all()
+
+    def join(self):
+        """Blocks until every lane ran dry"""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._lanes)
+
+    def shutdown(self):
+        self.join()
+        self._pool.shutdown()
@@ -0,0 +1,127 @@
+"""
+Append-only journal of an Artifactor session
+
+Every dispatched hook, the global and local updates its callbacks returned, and every write
+to the ``ArtifactStore`` is appended to the journal as a length prefixed pickle. Writes are
+buffered and synced to disk in batches by a thread of the journal, so a crash loses at most
+the last batch and the events never wait for the disk.
+
+Every session starts with a ``session`` entry. ``replay_journal`` rebuilds the global data of
+the last session in a journal, which is enough to render the report of a session whose server
+died, without running any plugin hook again.
+"""
+import os
+import pickle
+import struct
+import threading
+
+from iqe.artifactor.store import ArtifactStore
+from riggerlib import recursive_update
+
+_length = struct.Struct("!I")
+
+
+class Journal(object):
+    """An open journal file
+
+    Args:
+        filename: The journal file, appended to if it exists.
+        sync_every: Sync after this many entries...
+        sync_interval: ...or when the last sync is this many seconds ago.
+        on_error: Called with the exception if an entry can not be pickled, the entry is
+            left out of the journal. Without it the exception is raised.
+    """
+
+    def __init__(self, filename, sync_every=512, sync_interval=1.0, on_error=None):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.on_error = on_error
+        self._file = open(filename, "ab", buffering=1 << 16)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+        # set when sync_every entries are pending, the syncer syncs them right away
+        self._due = threading.Event()
+        self._syncer = threading.Thread(target=self._run, name="journal_sync", daemon=True)
+        self._syncer.start()
+
+    def append(self, *entry):
+        try:
+            data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            if self.on_error is None:
+                raise
+            self.on_error(e)
+            return
+        with self._lock:
+            if self._closed:
+                return
+            self._file.write(_length.pack(len(data)))
+            self._file.write(data)
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self._due.set()
+
+    def _run(self):
+        while not self._closed:
+            self._due.wait(self.sync_interval)
+            self._due.clear()
+            self.sync()
+
+    def sync(self):
+        """Writes the pending entries to disk"""
+        with self._lock:
+            if self._closed or not self._pending:
+                return
+            self._file.flush()
+            self._pending = 0
+            fd = os.dup(self._file.fileno())
+        # not under the lock, entries go on being appended meanwhile
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._due.set()
+        self._syncer.join()
+
+
+def read_journal(filename):
+    """Yields the entries of a journal, ignoring an entry cut short by a crash"""
+    with open(filename, "rb") as f:
+        while True:
+            header = f.read(_length.size)
+            if len(header) < _length.size:
+                return
+            (size,) = _length.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield pickle.loads(data)
+
+
+def replay_journal(filename):
+    """Rebuilds the global data of the last session of an Artifactor from its journal"""
+    global_data = {"artifacts": ArtifactStore(), "old_artifacts": {}}
+    for entry in read_journal(filename):
+        kind = entry[0]
+        if kind == "session":
+            # the journal is appended to, only the last session is rebuilt
+            global_data = {"artifacts": ArtifactStore(), "old_artifacts": {}}
+            global_data.update(entry[1])
+        elif kind == "update":
+            _, _, globals_updates = entry
+            recursive_update(global_data, globals_updates)
+        elif kind == "artifact":
+            _, method, args, kwargs = entry
+            getattr(global_data["artifacts"], method)(*args, **kwargs)
+    return global_data
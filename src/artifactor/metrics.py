@@ -0,0 +1,153 @@
+"""
+Minimal in-process metrics, rendered in the Prometheus text exposition format
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    """A metric family, one value per combination of label values"""
+
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in items:
+            yield self.name, self.labelnames, labelvalues, value
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labelnames, labelvalues, value in self._samples():
+            labels = _format_labels(labelnames, labelvalues)
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(Metric):
+    """Counts observations into buckets, the last bucket has to be +Inf"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            counts, total = self._values.get(labelvalues, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[labelvalues] = (counts, total + value)
+
+    def snapshot(self):
+        """Returns the bucket counts, not cumulative, and the sum for every label values"""
+        with self._lock:
+            return {
+                labelvalues: (list(counts), total)
+                for labelvalues, (counts, total) in self._values.items()
+            }
+
+    def _samples(self):
+        labelnames = self.labelnames + ("le",)
+        for labelvalues, (counts, total) in self.snapshot().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (
+                    self.name + "_bucket",
+                    labelnames,
+                    labelvalues + (_format_value(bound),),
+                    cumulative,
+                )
+            yield self.name + "_sum", self.labelnames, labelvalues, total
+            yield self.name + "_count", self.labelnames, labelvalues, cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        return "\n".join(metric.exposition() for metric in self._metrics) + "\n"
+
+
+def serve_metrics(registry, host, port):
+    """Serves the exposition of a registry on ``/metrics`` from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics_server")
+    thread.daemon = True
+    thread.start()
+    return server
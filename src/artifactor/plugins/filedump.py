@@ -9,24 +9,146 @@ artifactor:
         filedump:
             enabled: True
             plugin: filedump
+            write_behind: 4 # Write files on this many threads, unset to write in the hook
+            write_queue: 64 # The number of writes that may wait for a writer thread
+            dedup: False # Store identical contents once under artifact_dir and hardlink them
+            compression: gzip # Compress .log and .txt artifacts with gzip or zstd...
+            compression_threshold: 4096 # ...if their contents are at least this long
+            redact_words: [] # Words to redact, in addition to the ones passed to sanitize
+            redact_inline: False # Redact text contents as they are dumped, not only on sanitize
 """
 import base64
+import hashlib
 import os
 import re
+import shutil
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import partial
 
 from iqe.artifactor import ArtifactorBasePlugin
+from iqe.artifactor.redact import Redactor
+from iqe.artifactor.utils import compress
+from iqe.artifactor.utils import COMPRESSION_SUFFIXES
 from iqe.artifactor.utils import normalize_text
 from iqe.artifactor.utils import safe_string
 
+# Artifacts holding text, these are compressed if compression is configured
+TEXT_SUFFIXES = (".log", ".txt")
+# The types of artifacts sanitize redacts
+SANITIZED_TYPES = frozenset({"traceback", "short_tb", "rbac", "soft_traceback", "soft_short_tb"})
+
+
+class WriteBehind(object):
+    """Writes files on a thread pool, while the hook that dumped them carries on
+
+    At most ``max_pending`` writes are queued, submitting another one blocks until a write
+    finished. Writes to the same file run in the order they were submitted.
+
+    Args:
+        workers: The number of writer threads.
+        max_pending: The number of writes that may be queued.
+        log: Called with the exceptions of failed writes.
+    """
+
+    def __init__(self, workers, max_pending, log):
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="filedump_writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = defaultdict(set)
+        self._last_write = {}
+        self._log = log
+
+    def submit(self, test_ident, filename, func, *args):
+        self._slots.acquire()
+        with self._lock:
+            previous = self._last_write.get(filename)
+            future = self._pool.submit(self._run, previous, func, *args)
+            self._pending[test_ident].add(future)
+            self._last_write[filename] = future
+        future.add_done_callback(partial(self._done, test_ident, filename))
+
+    @staticmethod
+    def _run(previous, func, *args):
+        if previous is not None:
+            wait([previous])
+        func(*args)
+
+    def _done(self, test_ident, filename, future):
+        self._slots.release()
+        with self._lock:
+            pending = self._pending[test_ident]
+            pending.discard(future)
+            if not pending:
+                del self._pending[test_ident]
+            if self._last_write.get(filename) is future:
+                del self._last_write[filename]
+        if future.exception() is not None:
+            self._log(future.exception())
+
+    def wait(self, test_ident=None):
+        """Blocks until the writes of a test, or all writes, are done"""
+        with self._lock:
+            if test_ident is not None:
+                futures = list(self._pending.get(test_ident, ()))
+            else:
+                futures = [future for pending in self._pending.values() for future in pending]
+        wait(futures)
+
 
 class Filedump(ArtifactorBasePlugin):
+    class Stream(object):
+        def __init__(self, slaveid, test_ident, file, artifact):
+            self.slaveid = slaveid
+            self.test_ident = test_ident
+            self.file = file
+            self.artifact = artifact
+
     def plugin_initialize(self):
+        self.streams = {}
         self.register_plugin_hook("filedump", self.filedump)
+        self.register_plugin_hook("filedump_open", self.filedump_open)
+        self.register_plugin_hook("filedump_chunk", self.filedump_chunk)
+        self.register_plugin_hook("filedump_close", self.filedump_close)
         self.register_plugin_hook("sanitize", self.sanitize)
         self.register_plugin_hook("pre_start_test", self.start_test)
+        self.register_plugin_hook("finish_test", self.finish_test)
+        self.register_plugin_hook("finish_session", self.finish_session)
 
     def configure(self):
         self.configured = True
+        self.dedup = self.data.get("dedup", False)
+        self.compression = self.data.get("compression")
+        self.compression_threshold = self.data.get("compression_threshold", 4096)
+        self.redact_inline = self.data.get("redact_inline", False)
+        self.redact_words = list(self.data.get("redact_words", []))
+        # redacts the contents inline, the words passed to sanitize have their own
+        self.redactor = Redactor(self.redact_words) if self.redact_words else None
+        self._redactors = {}
+        self.writer = None
+        if self.data.get("write_behind"):
+            self.writer = WriteBehind(
+                self.data["write_behind"],
+                self.data.get("write_queue", 64),
+                self._rigger_instance.log_message,
+            )
+            for hook_name in ("finish_test", "sanitize", "build_report", "finish_session"):
+                self._rigger_instance.register_hook_callback(
+                    hook_name, "pre", self.await_writes, name=f"{self.ident}_await_writes"
+                )
+
+    def await_writes(self, test_location=None, test_name=None):
+        """
+        Pre hook callback blocking until the pending writes of a test, or of all tests for
+        session wide events, are on disk
+        """
+        if test_location and test_name:
+            self.writer.wait(f"{test_location}/{test_name}")
+        else:
+            self.writer.wait()
 
     def start_test(
         self, artifact_path, test_name, test_location, slaveid=None, metadata=None, param_dict=None
@@ -42,6 +164,8 @@ class Filedump(ArtifactorBasePlugin):
     @ArtifactorBasePlugin.check_configured
     def filedump(
         self,
+        artifacts,
+        artifact_dir,
         description,
         contents,
         slaveid=None,
@@ -58,25 +182,21 @@ class Filedump(ArtifactorBasePlugin):
     ):
         if not slaveid:
             slaveid = "Master"
-        test_ident = f"{self.store[slaveid]['test_location']}/{self.store[slaveid]['test_name']}"
-        artifacts = []
+        test_ident = self._test_ident(slaveid)
         if os_filename is None:
-            safe_name = re.sub(r"\s+", "_", normalize_text(safe_string(description)))
-            os_filename = self.ident + "-" + safe_name
-            os_filename = os.path.join(self.store[slaveid]["artifact_path"], os_filename)
-            if file_type is not None and "screenshot" in file_type:
-                os_filename = os_filename + ".png"
-            elif file_type is not None and (
-                "_tb" in file_type or "traceback" in file_type or file_type == "log"
-            ):
-                os_filename = os_filename + ".log"
-            elif file_type is not None and file_type == "html":
-                os_filename = os_filename + ".html"
-            elif file_type is not None and file_type == "video":
-                os_filename = os_filename + ".ogv"
-            else:
-                os_filename = os_filename + ".txt"
-        artifacts.append(
+            os_filename = self._os_filename(slaveid, description, file_type)
+        compression = None
+        if (
+            not dont_write
+            and self.compression
+            and "a" not in mode
+            and os_filename.endswith(TEXT_SUFFIXES)
+            and len(contents) >= self.compression_threshold
+        ):
+            compression = self.compression
+            os_filename += COMPRESSION_SUFFIXES[compression]
+        artifacts.add_file(
+            test_ident,
             {
                 "file_type": file_type,
                 "display_type": display_type,
@@ -84,40 +204,179 @@ class Filedump(ArtifactorBasePlugin):
                 "description": description,
                 "os_filename": os_filename,
                 "group_id": group_id,
-            }
+            },
         )
-        if not dont_write:
-            if os.path.isfile(os_filename):
-                os.remove(os_filename)
-            with open(os_filename, mode) as f:
-                if contents_base64:
-                    contents = base64.b64decode(contents)
+        if dont_write:
+            return
+        if (
+            self.redact_inline
+            and self.redactor is not None
+            and isinstance(contents, str)
+            and not contents_base64
+        ):
+            contents = self.redactor.redact(contents)
+        write = partial(
+            self._write, os_filename, contents, mode, contents_base64, compression, artifact_dir
+        )
+        if self.writer is not None:
+            self.writer.submit(test_ident, os_filename, write)
+        else:
+            write()
+
+    def _write(self, os_filename, contents, mode, contents_base64, compression, artifact_dir):
+        if os.path.isfile(os_filename):
+            os.remove(os_filename)
+        if contents_base64:
+            contents = base64.b64decode(contents)
+        if compression is not None:
+            if isinstance(contents, str):
+                contents = contents.encode("utf-8")
+            contents = compress(contents, compression)
+        if self.dedup and "a" not in mode:
+            if isinstance(contents, str):
+                contents = contents.encode("utf-8")
+            self._link_blob(os_filename, contents, os.path.join(artifact_dir, ".blobs"))
+            return
+        if not isinstance(contents, str) and "b" not in mode:
+            # binary contents, e.g. raw frames of the one-way channel
+            mode += "b"
+        with open(os_filename, mode) as f:
+            f.write(contents)
+
+    @ArtifactorBasePlugin.check_configured
+    def filedump_open(
+        self,
+        handle,
+        description,
+        slaveid=None,
+        mode="w",
+        display_type="primary",
+        display_glyph=None,
+        file_type=None,
+        os_filename=None,
+        group_id=None,
+    ):
+        """Opens a streamed artifact, its contents follow in ``filedump_chunk`` events
+
+        ``handle`` is picked by the client and names the stream in the following events. The
+        chunks are written as they come, they are neither written behind, compressed,
+        deduplicated nor redacted inline, ``sanitize`` still redacts the closed file. Streams
+        a slave left open are closed by its next ``finish_test``, or by ``finish_session``.
+        """
+        if not slaveid:
+            slaveid = "Master"
+        if os_filename is None:
+            os_filename = self._os_filename(slaveid, description, file_type)
+        if os.path.isfile(os_filename):
+            os.remove(os_filename)
+        self.streams[handle] = self.Stream(
+            slaveid,
+            self._test_ident(slaveid),
+            open(os_filename, mode.replace("b", "") + "b"),
+            {
+                "file_type": file_type,
+                "display_type": display_type,
+                "display_glyph": display_glyph,
+                "description": description,
+                "os_filename": os_filename,
+                "group_id": group_id,
+            },
+        )
+
+    @ArtifactorBasePlugin.check_configured
+    def filedump_chunk(self, handle, contents, contents_base64=False):
+        if contents_base64:
+            contents = base64.b64decode(contents)
+        elif isinstance(contents, str):
+            contents = contents.encode("utf-8")
+        self.streams[handle].file.write(contents)
+
+    @ArtifactorBasePlugin.check_configured
+    def filedump_close(self, artifacts, handle):
+        """Closes a streamed artifact and only then adds it to the artifacts of its test"""
+        stream = self.streams.pop(handle, None)
+        if stream is None:
+            # closed by finish_test already
+            return
+        stream.file.close()
+        artifacts.add_file(stream.test_ident, stream.artifact)
+
+    @ArtifactorBasePlugin.check_configured
+    def finish_test(self, artifacts, slaveid=None):
+        self._close_streams(artifacts, slaveid or "Master")
+
+    @ArtifactorBasePlugin.check_configured
+    def finish_session(self, artifacts):
+        self._close_streams(artifacts)
+
+    def _close_streams(self, artifacts, slaveid=None):
+        """
+        Closes the streams of a slave, or all of them, that were never closed, e.g. as their
+        worker crashed, keeping what they got so far
+        """
+        for handle, stream in list(self.streams.items()):
+            if slaveid is None or stream.slaveid == slaveid:
+                self._rigger_instance.log_message(
+                    f"closing the stream of {stream.artifact['os_filename']} left open"
+                )
+                self.filedump_close(artifacts, handle)
+
+    @staticmethod
+    def _link_blob(os_filename, contents, blob_dir):
+        """Stores contents once, named by their hash, and hardlinks them to ``os_filename``"""
+        digest = hashlib.sha256(contents).hexdigest()
+        blob = os.path.join(blob_dir, digest[:2], digest)
+        if not os.path.isfile(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # concurrent writers of the same blob each write their own temporary file
+            tmp = f"{blob}.{uuid.uuid4().hex}"
+            with open(tmp, "wb") as f:
                 f.write(contents)
+            os.replace(tmp, blob)
+        try:
+            os.link(blob, os_filename)
+        except OSError:
+            # different filesystem or no hardlink support
+            shutil.copyfile(blob, os_filename)
+
+    def _test_ident(self, slaveid):
+        return f"{self.store[slaveid]['test_location']}/{self.store[slaveid]['test_name']}"
+
+    def _os_filename(self, slaveid, description, file_type):
+        safe_name = re.sub(r"\s+", "_", normalize_text(safe_string(description)))
+        os_filename = self.ident + "-" + safe_name
+        os_filename = os.path.join(self.store[slaveid]["artifact_path"], os_filename)
+        if file_type is not None and "screenshot" in file_type:
+            return os_filename + ".png"
+        elif file_type is not None and (
+            "_tb" in file_type or "traceback" in file_type or file_type == "log"
+        ):
+            return os_filename + ".log"
+        elif file_type is not None and file_type == "html":
+            return os_filename + ".html"
+        elif file_type is not None and file_type == "video":
+            return os_filename + ".ogv"
+        else:
+            return os_filename + ".txt"
 
-        return None, {"artifacts": {test_ident: {"files": artifacts}}}
+    def _get_redactor(self, words):
+        """
+        Returns a Redactor for the words and the configured ones, compiled once per set of
+        words, so sanitize events of different slaves never replace each other's
+        """
+        key = frozenset(words)
+        redactor = self._redactors.get(key)
+        if redactor is None:
+            redactor = self._redactors.setdefault(key, Redactor(self.redact_words + list(key)))
+        return redactor
 
     @ArtifactorBasePlugin.check_configured
     def sanitize(self, test_location, test_name, artifacts, words):
         test_ident = f"{test_location}/{test_name}"
-        filename = None
+        redactor = self._get_redactor(words)
         try:
             for f in artifacts[test_ident]["files"]:
-                if f["file_type"] not in {
-                    "traceback",
-                    "short_tb",
-                    "rbac",
-                    "soft_traceback",
-                    "soft_short_tb",
-                }:
-                    continue
-                filename = f["os_filename"]
-                with open(filename) as f:
-                    data = f.read()
-                for word in words:
-                    if not isinstance(word, str):
-                        word = str(word)
-                    data = data.replace(word, "*" * len(word))
-                with open(filename, "w") as f:
-                    f.write(data)
+                if f["file_type"] in SANITIZED_TYPES:
+                    redactor.redact_file(f["os_filename"])
         except KeyError:
             pass
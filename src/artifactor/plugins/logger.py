@@ -10,18 +10,70 @@ artifactor:
             enabled: True
             plugin: logger
             level: DEBUG
+            slave_levels: # Levels of single slaves, overriding level
+                gw0: INFO
+            compression: gzip # Write the test logs compressed with gzip or zstd
+            flush_size: 65536 # Write the test logs out in blocks of this many bytes...
+            flush_interval: 1.0 # ...and flush what was written at least this often
+            max_open: 64 # Keep at most this many test logs open...
+            idle_timeout: 300 # ...and close the ones not written to for this many seconds
 """
 import os
+import threading
+import time
+from collections import Counter
+from collections import OrderedDict
+from functools import partial
 from logging import FileHandler
 from logging import Formatter
+from logging import getLevelName
 from logging import makeLogRecord
 
 from iqe.artifactor import ArtifactorBasePlugin
+from iqe.artifactor.utils import COMPRESSION_SUFFIXES
+from iqe.artifactor.utils import open_artifact
+
+
+class ArtifactFileHandler(FileHandler):
+    """A FileHandler that compresses the log if its file name asks for it
+
+    Unlike a FileHandler it does not flush after every record, it writes out blocks of
+    ``flush_size`` bytes, and flushes when a record comes in ``flush_interval`` seconds
+    after the last flush, or when ``force_flush()`` is called. The HandlerPool calls
+    ``flush()`` on a timer too, so the last records of a test that went quiet are written.
+    """
+
+    def __init__(self, filename, flush_size=1 << 16, flush_interval=1.0, **kw):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        super().__init__(filename, **kw)
+
+    def _open(self):
+        kw = {"encoding": self.encoding, "errors": self.errors}
+        if not self.baseFilename.endswith(tuple(COMPRESSION_SUFFIXES.values())):
+            kw["buffering"] = self.flush_size
+        return open_artifact(self.baseFilename, self.mode, **kw)
+
+    def flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.force_flush()
+
+    def force_flush(self):
+        super().flush()
+        self._last_flush = time.monotonic()
+
+
+def _make_log_record(log_record):
+    # json transport fallout: args must be a dict or a tuple, json makes a tuple into a list
+    args = log_record["args"]
+    log_record["args"] = tuple(args) if isinstance(args, list) else args
+    return makeLogRecord(log_record)
 
 
 def _make_file_handler(filename, root, level=None, **kw):
     filename = os.path.join(root, filename)
-    handler = FileHandler(filename, **kw)
+    handler = ArtifactFileHandler(filename, **kw)
     formatter = Formatter(
         "%(asctime)-15s [%(levelname).1s] [%(name)s] %(message)s (%(pathname)s:%(lineno)s)"
     )
@@ -31,26 +83,134 @@ def _make_file_handler(filename, root, level=None, **kw):
     return handler
 
 
+class HandlerPool(object):
+    """Keeps the log handlers of at most ``max_open`` slaves open
+
+    A handler is opened by the factory registered for its slave, called with the mode to open
+    the file in. When more than ``max_open`` handlers are open, or a handler was not used
+    for ``idle_timeout`` seconds, it is closed and reopened in append mode when its slave logs
+    again, so slaves that never finish their test can not exhaust the file descriptors.
+
+    Once ``start_flusher()`` was called, the open handlers are flushed every
+    ``flush_interval`` seconds from a daemon thread.
+    """
+
+    def __init__(self, max_open=64, idle_timeout=300.0, flush_interval=1.0):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.flush_interval = flush_interval
+        self.evictions = 0
+        self._flusher = None
+        self._lock = threading.Lock()
+        self._factories = {}
+        self._open = OrderedDict()
+        self._busy = Counter()
+
+    def open(self, slaveid, factory):
+        """Opens the handler of a slave, truncating its file"""
+        self.close(slaveid)
+        with self._lock:
+            self._factories[slaveid] = factory
+            self._open[slaveid] = (factory(mode="w"), time.monotonic())
+            self._evict()
+
+    def handle(self, slaveid, records):
+        """Passes the records to the handler of a slave, if it has one"""
+        with self._lock:
+            entry = self._open.pop(slaveid, None)
+            if entry is not None:
+                handler = entry[0]
+            elif slaveid in self._factories:
+                handler = self._factories[slaveid](mode="a")
+            else:
+                return
+            self._open[slaveid] = (handler, time.monotonic())
+            self._busy[slaveid] += 1
+            self._evict()
+        try:
+            for record in records:
+                handler.handle(record)
+        finally:
+            with self._lock:
+                self._busy[slaveid] -= 1
+                if not self._busy[slaveid]:
+                    del self._busy[slaveid]
+
+    def close(self, slaveid):
+        """Closes the handler of a slave for good"""
+        with self._lock:
+            self._factories.pop(slaveid, None)
+            entry = self._open.pop(slaveid, None)
+        if entry is not None:
+            entry[0].close()
+
+    def close_all(self):
+        for slaveid in list(self._factories):
+            self.close(slaveid)
+
+    def flush(self):
+        """Flushes the open handlers that did not flush for ``flush_interval`` seconds"""
+        with self._lock:
+            handlers = [handler for handler, _ in self._open.values()]
+        for handler in handlers:
+            handler.flush()
+
+    def start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, name="logger_flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _evict(self):
+        """Closes least recently used handlers, these are in front of the OrderedDict"""
+        now = time.monotonic()
+        for slaveid, (handler, last_used) in list(self._open.items()):
+            if len(self._open) <= self.max_open and now - last_used < self.idle_timeout:
+                break
+            if self._busy[slaveid]:
+                continue
+            del self._open[slaveid]
+            handler.close()
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        return {"open": len(self._open), "evictions": self.evictions}
+
+
 class Logger(ArtifactorBasePlugin):
     class Test(object):
         def __init__(self, ident):
             self.ident = ident
             self.in_progress = False
-            self.handler = None
-
-        def close(self):
-            if self.handler is not None:
-                self.handler.close()
-                self.handler = None
 
     def plugin_initialize(self):
         self.register_plugin_hook("start_test", self.start_test)
         self.register_plugin_hook("finish_test", self.finish_test)
         self.register_plugin_hook("log_message", self.log_message)
+        self.register_plugin_hook("log_messages", self.log_messages)
+        self.register_plugin_hook("log_level", self.log_level)
+        self.register_plugin_hook("finish_session", self.finish_session)
 
     def configure(self):
         self.configured = True
         self.level = self.data.get("level", "DEBUG")
+        self.slave_levels = self.data.get("slave_levels") or {}
+        self.compression = self.data.get("compression")
+        self.flush_size = self.data.get("flush_size", 1 << 16)
+        self.flush_interval = self.data.get("flush_interval", 1.0)
+        if not hasattr(self, "handlers"):
+            self.handlers = HandlerPool()
+        self.handlers.max_open = self.data.get("max_open", 64)
+        self.handlers.idle_timeout = self.data.get("idle_timeout", 300.0)
+        self.handlers.flush_interval = self.flush_interval
+        self.handlers.start_flusher()
 
     @ArtifactorBasePlugin.check_configured
     def start_test(self, artifact_path, test_name, test_location, slaveid=None):
@@ -61,16 +221,21 @@ class Logger(ArtifactorBasePlugin):
             if self.store[slaveid].in_progress:
                 print("Test already running, can't start another, logger")
                 return None
-            self.store[slaveid].close()
         self.store[slaveid] = self.Test(test_ident)
         self.store[slaveid].in_progress = True
         filename = f"{self.ident}-iqe.log"
-        self.store[slaveid].handler = _make_file_handler(
-            filename,
-            root=artifact_path,
-            # we overwrite
-            mode="w",
-            level=self.level,
+        if self.compression:
+            filename += COMPRESSION_SUFFIXES[self.compression]
+        # we overwrite, the pool opens the log with mode w first
+        self.handlers.open(
+            slaveid,
+            partial(
+                _make_file_handler,
+                filename,
+                root=artifact_path,
+                flush_size=self.flush_size,
+                flush_interval=self.flush_interval,
+            ),
         )
 
         self.fire_hook(
@@ -87,22 +252,55 @@ class Logger(ArtifactorBasePlugin):
             group_id="pytest-logfile",
         )
 
+    def level_for(self, slaveid):
+        """Returns the level the records of a slave are logged at, as a number"""
+        level = self.slave_levels.get(slaveid, self.level)
+        return level if isinstance(level, int) else getLevelName(level.upper())
+
+    @ArtifactorBasePlugin.check_configured
+    def log_level(self, slaveid=None):
+        """
+        Query hook for clients, so they can drop records that would not be logged before
+        sending them
+        """
+        if not slaveid:
+            slaveid = "Master"
+        return {"log_level": self.level_for(slaveid)}, None
+
     @ArtifactorBasePlugin.check_configured
     def finish_test(self, artifact_path, test_name, test_location, slaveid=None):
         if not slaveid:
             slaveid = "Master"
         self.store[slaveid].in_progress = False
-        self.store[slaveid].close()
+        self.handlers.close(slaveid)
+
+    @ArtifactorBasePlugin.check_configured
+    def finish_session(self):
+        self._rigger_instance.log_message(
+            "logger {}: {evictions} test logs closed early, {open} still open".format(
+                self.ident, **self.handlers.stats
+            )
+        )
+        self.handlers.close_all()
 
     @ArtifactorBasePlugin.check_configured
     def log_message(self, log_record, slaveid=None):
-        # json transport fallout: args must be a dict or a tuple, json makes a tuple into a list
-        args = log_record["args"]
-        log_record["args"] = tuple(args) if isinstance(args, list) else args
-        record = makeLogRecord(log_record)
+        record = _make_log_record(log_record)
         if not slaveid:
             slaveid = "Master"
-        if slaveid in self.store:
-            handler = self.store[slaveid].handler
-            if handler and record.levelno >= handler.level:
-                handler.handle(record)
+        if record.levelno >= self.level_for(slaveid):
+            self.handlers.handle(slaveid, [record])
+
+    @ArtifactorBasePlugin.check_configured
+    def log_messages(self, log_records, slaveid=None):
+        """Like log_message, for a list of records"""
+        if not slaveid:
+            slaveid = "Master"
+        level = self.level_for(slaveid)
+        records = [
+            _make_log_record(log_record)
+            for log_record in log_records
+            if log_record.get("levelno", level) >= level
+        ]
+        if records:
+            self.handlers.handle(slaveid, records)
@@ -1,4 +1,4 @@
-""" Logger plugin for Artifactor
+""" Prometheus plugin for Artifactor
 
 Add a stanza to the artifactor config like this,
 artifactor:
@@ -6,13 +6,29 @@ artifactor:
     per_run: test #test, run, None
     overwrite: True
     plugins:
-        logger:
+        prometheus:
             enabled: True
-            plugin: logger
-            level: DEBUG
+            plugin: prometheus
+            host: 127.0.0.1 # The metrics service prometheus_finish_test pushes to
+            port: 5000
+            metrics_host: 127.0.0.1 # Serve the metrics on http://metrics_host:metrics_port/metrics
+            metrics_port: 9100
+            push_path: /add_metrics # Takes a POST of a JSON list of metrics per batch
+            push_queue: 1000 # Submissions waiting to be pushed, further ones are spilled
+            push_timeout: 5.0
 """
+import json
+import os
+import threading
+from collections import deque
+
 import requests
 from iqe.artifactor import ArtifactorBasePlugin
+from iqe.artifactor.metrics import Counter
+from iqe.artifactor.metrics import Gauge
+from iqe.artifactor.metrics import Histogram
+from iqe.artifactor.metrics import Registry
+from iqe.artifactor.metrics import serve_metrics
 
 
 def overall_test_status(statuses):
@@ -31,6 +47,112 @@ def overall_test_status(statuses):
     return "passed"
 
 
+class Pusher(object):
+    """Pushes metric submissions to the metrics service from a background thread
+
+    Submissions are queued and sent in batches over one pooled session, every batch as a
+    single POST of a JSON list of the metrics to ``url``. Failed batches go back to the front
+    of the queue and are retried with exponential backoff, up to ``max_attempts`` times.
+    Submissions that are given up on, or that do not fit into the queue of ``max_queue``, are
+    appended to ``spill_file``, one JSON metric per line, so they can be submitted again later.
+
+    Args:
+        log: Called with the exceptions of failed spills.
+    """
+
+    def __init__(
+        self,
+        url,
+        spill_file,
+        log,
+        max_queue=1000,
+        batch_size=50,
+        timeout=5.0,
+        max_attempts=5,
+        max_backoff=60.0,
+    ):
+        self.url = url
+        self.spill_file = spill_file
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self._log = log
+        self._queue = deque()
+        self._cond = threading.Condition()
+        # set by close, the queue is drained without waiting for more submissions...
+        self._closing = False
+        # ...until it is given up on
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="prometheus_pusher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, metric):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self._spill([self._queue.popleft()])
+            self._queue.append((metric, 0))
+            self._cond.notify()
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closing)
+                if self._closed or not self._queue:
+                    return
+                size = min(self.batch_size, len(self._queue))
+                batch = [self._queue.popleft() for _ in range(size)]
+            try:
+                self.session.post(
+                    self.url, json=[metric for metric, _ in batch], timeout=self.timeout
+                ).raise_for_status()
+            except requests.exceptions.RequestException:
+                failures += 1
+            else:
+                failures = 0
+                continue
+            failed = [(metric, attempts + 1) for metric, attempts in batch]
+            retry = [item for item in failed if item[1] < self.max_attempts]
+            self._spill([item for item in failed if item[1] >= self.max_attempts])
+            with self._cond:
+                if self._closed:
+                    self._spill(retry)
+                    return
+                self._queue.extendleft(reversed(retry))
+                while len(self._queue) > self.max_queue:
+                    self._spill([self._queue.pop()])
+                self._cond.wait_for(
+                    lambda: self._closed, min(self.max_backoff, 0.5 * 2 ** failures)
+                )
+
+    def _spill(self, items):
+        if not items:
+            return
+        try:
+            with open(self.spill_file, "a") as f:
+                for metric, _ in items:
+                    f.write(json.dumps(metric) + "\n")
+        except OSError as e:
+            self._log(e)
+
+    def close(self, timeout=10.0):
+        """Gives the queue ``timeout`` seconds to drain, then spills what is left"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._spill(list(self._queue))
+            self._queue.clear()
+        self.session.close()
+
+
 class Prometheus(ArtifactorBasePlugin):
     class Test(object):
         def __init__(self, ident):
@@ -40,11 +162,35 @@ class Prometheus(ArtifactorBasePlugin):
     def plugin_initialize(self):
         self.register_plugin_hook("start_test", self.start_test)
         self.register_plugin_hook("prometheus_finish_test", self.finish_test)
+        self.register_plugin_hook("finish_session", self.finish_session)
 
     def configure(self):
         self.configured = True
         self.host = self.data.get("host", "127.0.0.1")
         self.port = self.data.get("port", "5000")
+        if getattr(self, "pusher", None) is not None:
+            self.pusher.close()
+        self.pusher = None
+        if not hasattr(self, "registry"):
+            self.registry = Registry()
+            self.outcomes = self.registry.register(
+                Counter("artifactor_test_outcomes_total", "Finished tests by outcome", ["outcome"])
+            )
+            self.durations = self.registry.register(
+                Histogram(
+                    "artifactor_test_duration_seconds",
+                    "Durations of finished tests",
+                    ["test_location"],
+                )
+            )
+            self.in_progress = self.registry.register(
+                Gauge("artifactor_tests_in_progress", "Tests running on a slave", ["slaveid"])
+            )
+            self.server = None
+        if self.server is None and self.data.get("metrics_port") is not None:
+            self.server = serve_metrics(
+                self.registry, self.data.get("metrics_host", "127.0.0.1"), self.data["metrics_port"]
+            )
 
     @ArtifactorBasePlugin.check_configured
     def start_test(self, artifact_path, test_name, test_location, slaveid=None):
@@ -57,6 +203,7 @@ class Prometheus(ArtifactorBasePlugin):
                 return None
         self.store[slaveid] = self.Test(test_ident)
         self.store[slaveid].in_progress = True
+        self.in_progress.set(1, slaveid)
 
     @ArtifactorBasePlugin.check_configured
     def finish_test(
@@ -66,22 +213,36 @@ class Prometheus(ArtifactorBasePlugin):
         if not slaveid:
             slaveid = "Master"
         self.store[slaveid].in_progress = False
+        self.in_progress.set(0, slaveid)
         test_data = artifacts[test_ident]
         try:
             duration = test_data["finish_time"] - test_data["start_time"]
         except Exception as e:
             print(e)
             duration = 0.0
+        self.outcomes.inc(overall_test_status(test_data["statuses"]))
+        self.durations.observe(duration, test_location)
         if prometheus:
-            try:
-                requests.get(
-                    "http://{}:{}/add_metric/{}/{}/{}".format(
-                        self.host,
-                        self.port,
-                        test_name,
-                        overall_test_status(artifacts[test_ident]["statuses"]),
-                        duration,
-                    )
+            if self.pusher is None:
+                self.pusher = Pusher(
+                    "http://{}:{}{}".format(
+                        self.host, self.port, self.data.get("push_path", "/add_metrics")
+                    ),
+                    os.path.join(log_dir, f"{self.ident}-spill.txt"),
+                    self._rigger_instance.log_message,
+                    max_queue=self.data.get("push_queue", 1000),
+                    timeout=self.data.get("push_timeout", 5.0),
                 )
-            except requests.exceptions.ConnectionError:
-                return
+            self.pusher.submit(
+                {
+                    "test_name": test_name,
+                    "status": overall_test_status(test_data["statuses"]),
+                    "duration": duration,
+                }
+            )
+
+    @ArtifactorBasePlugin.check_configured
+    def finish_session(self):
+        if self.pusher is not None:
+            self.pusher.close()
+            self.pusher = None
@@ -11,30 +11,52 @@ artifactor:
             enabled: True
             plugin: reporter
             only_failed: False #Only show faled tests in the report
+            sharded: False # Write an index page and one page per top-level module
+            formats: [html] # html and/or json, report.json is viewed with report_viewer.html
+            json_compression: gzip # Write report.json.gz instead, the viewer reads no other
+            read_workers: 8 # Read the tracebacks and qa contacts of tests on this many threads
+            tb_preview: 2000 # Only embed this many characters of a traceback and link the file
+            assets: copy # Copy the static assets next to the report, or symlink them
+            bytecode_cache: /tmp/artifactor-templates # Keep compiled templates on disk
 """
 import csv
 import datetime
+import hashlib
+import json
 import math
 import os
 import re
 import shutil
+import sys
+import threading
 import time
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import lru_cache
+from functools import partial
 from pathlib import Path
 
 from iqe import artifactor
 from iqe.artifactor import ArtifactorBasePlugin
+from iqe.artifactor.utils import COMPRESSION_SUFFIXES
+from iqe.artifactor.utils import open_artifact
 from iqe.artifactor.utils import process_pytest_path
 from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
 from jinja2 import FileSystemLoader
 
 TEMPLATE_PATH = Path(os.path.split(artifactor.__file__)[0], "templates")
-
-_tests_tpl = {
-    "_sub": {},
-    "_stats": {"passed": 0, "failed": 0, "skipped": 0, "error": 0, "xpassed": 0, "xfailed": 0},
-    "_duration": 0,
-}
+ASSETS_PATH = TEMPLATE_PATH / "dist"
+# Written into deployed assets, holds the digest of the assets they were copied from
+ASSETS_MANIFEST = ".manifest"
+# Number of template events rendered before they are written out together
+RENDER_BUFFER = 256
+# The page rendering the json export in the browser
+VIEWER = "report_viewer.html"
+
+# The statuses the module tree counts, in the order of the counts of its modules
+STATUSES = ("passed", "failed", "skipped", "error", "xpassed", "xfailed")
+_STATUS_INDEX = {status: index for index, status in enumerate(STATUSES)}
 
 # Regexp, that finds all URLs in a string
 # Does not cover all the cases, but rather only those we can
@@ -57,14 +79,533 @@ def overall_test_status(statuses):
     return "passed"
 
 
+STATUS_COLORS = {
+    "passed": "success",
+    "failed": "warning",
+    "error": "danger",
+    "xpassed": "danger",
+    "xfailed": "success",
+    "skipped": "info",
+}
+
+
+# Label classes of the statuses in the module tree
+TREE_LABELS = {
+    "passed": "success",
+    "failed": "warning",
+    "error": "danger",
+    "skipped": "primary",
+    "xpassed": "danger",
+    "xfailed": "success",
+}
+
+
+def report_dir(artifact_dir, run_type, run_id):
+    """Returns the directory the report of a run is written to"""
+    if run_type == "run" and run_id:
+        return str(os.path.join(artifact_dir, run_id))
+    return artifact_dir
+
+
+@lru_cache(maxsize=None)
+def template_env(bytecode_cache_dir=None):
+    """
+    Returns the template environment, shared by all reports so every template is only
+    compiled once per process, or loaded from the bytecode cache if one is given
+    """
+    kwargs = {}
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        kwargs["bytecode_cache"] = FileSystemBytecodeCache(bytecode_cache_dir)
+    return Environment(loader=FileSystemLoader(str(TEMPLATE_PATH)), auto_reload=False, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def assets_digest():
+    """Returns the digest of the names and contents of the static assets"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(ASSETS_PATH):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, ASSETS_PATH).encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(partial(f.read, 1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Asset directories deployed by this process
+_deployed_assets = set()
+
+
+def deploy_assets(log_dir, mode="copy"):
+    """Puts the static assets of the report pages into ``dist`` in the log dir
+
+    Each log dir is only looked at once per process. With ``mode="copy"`` the assets are only
+    copied if the manifest of the ones already there doesn't match, with ``mode="symlink"`` a
+    link to the installed assets is made instead.
+    """
+    target = os.path.join(log_dir, "dist")
+    if target in _deployed_assets or not ASSETS_PATH.is_dir():
+        return
+    if mode == "symlink":
+        if os.path.realpath(target) != os.path.realpath(str(ASSETS_PATH)):
+            _remove_assets(target)
+            os.symlink(str(ASSETS_PATH), target)
+    else:
+        manifest = os.path.join(target, ASSETS_MANIFEST)
+        try:
+            with open(manifest) as f:
+                deployed = f.read()
+        except OSError:
+            deployed = None
+        if deployed != assets_digest():
+            _remove_assets(target)
+            shutil.copytree(str(ASSETS_PATH), target)
+            with open(manifest, "w") as f:
+                f.write(assets_digest())
+    _deployed_assets.add(target)
+
+
+def _remove_assets(target):
+    if os.path.islink(target):
+        os.unlink(target)
+    elif os.path.isdir(target):
+        shutil.rmtree(target)
+
+
+def pretty_duration(seconds):
+    return str(datetime.timedelta(seconds=math.ceil(seconds)))
+
+
+def _tree_path(test_data):
+    return process_pytest_path(test_data["name"].replace("iqe/", ""))
+
+
+class ModuleNode(object):
+    """A module of the tree, its children by name and the totals of the tests under it
+
+    The children are modules or the test_data of tests. ``counts`` holds the number of tests
+    under the module per status, in the order of STATUSES.
+    """
+
+    __slots__ = ("sub", "counts", "duration")
+
+    def __init__(self):
+        self.sub = {}
+        self.counts = [0] * len(STATUSES)
+        self.duration = 0
+
+    @property
+    def stats(self):
+        return dict(zip(STATUSES, self.counts))
+
+    def pass_percentage(self):
+        """Returns the percentage of the tests under the module that passed, None for none"""
+        total = sum(self.counts)
+        if not total:
+            return None
+        good = self.counts[_STATUS_INDEX["passed"]] + self.counts[_STATUS_INDEX["xfailed"]]
+        return good / total * 100
+
+
+class ModuleTree(object):
+    """
+    The module tree of the tests the tree of the report is built from, kept up to date test
+    by test. Every change walks the path of a test once, so it costs the depth of the test.
+    """
+
+    def __init__(self):
+        self.root = ModuleNode()
+        self.root.sub["tests"] = ModuleNode()
+
+    def _walk(self, segs, create=False):
+        """Returns the modules on the way to a test, from the root to its parent"""
+        nodes = [self.root]
+        for seg in segs[:-1]:
+            sub = nodes[-1].sub.get(seg)
+            if sub is None:
+                if not create:
+                    raise KeyError(seg)
+                sub = nodes[-1].sub[seg] = ModuleNode()
+            nodes.append(sub)
+        return nodes
+
+    def add(self, test_data):
+        segs = _tree_path(test_data)
+        index = _STATUS_INDEX[test_data["outcomes"]["overall"]]
+        duration = test_data.get("seconds", 0)
+        nodes = self._walk(segs, create=True)
+        for node in nodes:
+            node.counts[index] += 1
+            node.duration += duration
+        nodes[-1].sub[segs[-1]] = test_data
+
+    def replace(self, old, new):
+        """Puts ``new`` in the place of ``old``, a test of the same name, moving its counts"""
+        segs = _tree_path(new)
+        old_index = _STATUS_INDEX[old["outcomes"]["overall"]]
+        new_index = _STATUS_INDEX[new["outcomes"]["overall"]]
+        delta = new.get("seconds", 0) - old.get("seconds", 0)
+        nodes = self._walk(segs)
+        for node in nodes:
+            node.counts[old_index] -= 1
+            node.counts[new_index] += 1
+            node.duration += delta
+        nodes[-1].sub[segs[-1]] = new
+
+    def remove(self, test_data):
+        segs = _tree_path(test_data)
+        index = _STATUS_INDEX[test_data["outcomes"]["overall"]]
+        duration = test_data.get("seconds", 0)
+        nodes = self._walk(segs)
+        for node in nodes:
+            node.counts[index] -= 1
+            node.duration -= duration
+        if nodes[-1].sub.get(segs[-1]) is test_data:
+            del nodes[-1].sub[segs[-1]]
+        # drop the modules that are left empty, but the tests module that is always there
+        for parent, seg, node in reversed(list(zip(nodes, segs, nodes[1:]))):
+            if node.sub or (parent is self.root and seg == "tests"):
+                break
+            del parent.sub[seg]
+
+    def retime(self, test_data, seconds):
+        """Changes the duration of a test in the tree, for tests in progress"""
+        delta = seconds - test_data.get("seconds", 0)
+        test_data["seconds"] = seconds
+        test_data["duration"] = pretty_duration(seconds)
+        for node in self._walk(_tree_path(test_data)):
+            node.duration += delta
+
+
+def _file_key(filename):
+    """Returns the mtime and size of a file, None if it is not there (yet)"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _fingerprint(test):
+    """What the test_data of a test is built from, the side files by their mtime and size"""
+    files = test.get("files") or ()
+    return (
+        id(test),
+        tuple(test["statuses"].items()),
+        test.get("start_time"),
+        test.get("finish_time"),
+        test.get("slaveid"),
+        len(files),
+        tuple(
+            _file_key(file_dict["os_filename"])
+            for file_dict in files
+            if file_dict["file_type"] in SideFiles.types
+        ),
+        test.get("skipped"),
+        test.get("composite"),
+        test.get("old", False),
+    )
+
+
+class SideFiles(object):
+    """Reads the files of tests the report embeds, short tracebacks and qa contacts
+
+    What is read from a file is cached for as long as its mtime and size stay the same, and
+    files can be read ahead on a thread pool, so slow filesystems are waited on in parallel.
+
+    Args:
+        workers: The number of threads reading ahead.
+        preview: If set, only that many characters of a traceback are read.
+    """
+
+    types = frozenset({"short_tb", "qa_contact"})
+
+    def __init__(self, workers=8, preview=None):
+        self.preview = preview
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="reporter_reader")
+        self._cache = {}
+
+    def prefetch(self, file_dicts):
+        """Reads the side files among the files of tests on the thread pool"""
+        futures = [
+            self._pool.submit(self.read, file_dict["file_type"], file_dict["os_filename"])
+            for file_dict in file_dicts
+            if file_dict["file_type"] in self.types
+        ]
+        # errors are raised again when the file is read for the test
+        wait(futures)
+
+    def read(self, file_type, filename):
+        """
+        Returns the rows of a qa contact file, or a short traceback as the text, the URLs in
+        it and whether it was cut short for the preview
+        """
+        key = _file_key(filename)
+        cached = self._cache.get(filename)
+        if key is not None and cached is not None and cached[0] == key:
+            return cached[1]
+        if file_type == "qa_contact":
+            with open_artifact(filename, newline="") as qafile:
+                value = list(csv.reader(qafile, delimiter=",", quotechar='"'))
+        else:
+            with open_artifact(filename) as short_tb:
+                if self.preview is None:
+                    text = short_tb.read()
+                    truncated = False
+                else:
+                    text = short_tb.read(self.preview + 1)
+                    truncated = len(text) > self.preview
+                    text = text[: self.preview]
+            # a URL running into the end of a preview is cut short, leave it out
+            urls = [
+                match.group()
+                for match in URL.finditer(text)
+                if match.end() < len(text) or not truncated
+            ]
+            value = (text, urls, truncated)
+        self._cache[filename] = (key, value)
+        return value
+
+    def forget(self, filename):
+        """Drops what was read from a file, for files rewritten within the mtime resolution"""
+        self._cache.pop(filename, None)
+
+
+class ReportModel(object):
+    """The test_data of the tests of a report, and the counts and the module tree over them
+
+    The events of a test mark it dirty, and only the dirty tests are looked at again when the
+    report is built, the first time every test is. The test_data of a dirty test is only
+    built again when its record or its side files changed, or it was invalidated, and the
+    counts and the tree are updated by the difference, so the cost of building a report is
+    the number of tests that changed since the last one, not the number of tests. Tests in
+    progress only get their duration updated.
+
+    Entries are only built when the report is, the side files are read after the writes of
+    filedump and the sanitizing of the tests are done.
+
+    Args:
+        log_dir: The directory of the report, file names are made relative to it.
+        side_files: The SideFiles the tracebacks and qa contacts of tests are read with.
+    """
+
+    def __init__(self, log_dir, side_files=None):
+        self.log_dir = str(Path(log_dir)) + "/"
+        self.side_files = side_files or SideFiles()
+        self.entries = {}
+        self.tree = ModuleTree()
+        self.counts = dict.fromkeys(STATUS_COLORS, 0)
+        self.current_counts = dict.fromkeys(STATUS_COLORS, 0)
+        self.skip_counts = {"blocker": 0, "provider": 0}
+        # qa contacts with the number of tests they own, in the order they came up
+        self.qa = {}
+        self._fingerprints = {}
+        self._dirty = set()
+        # every test is looked at on the next refresh, not only the dirty ones
+        self._all_dirty = True
+        self._in_progress = set()
+        self._lock = threading.RLock()
+
+    def mark(self, name):
+        """Marks a test whose record changed, to be looked at on the next refresh"""
+        with self._lock:
+            self._dirty.add(name)
+
+    def mark_all(self):
+        """Marks all tests, for when the artifacts were replaced as a whole"""
+        with self._lock:
+            self._all_dirty = True
+
+    def refresh(self, artifacts):
+        """Brings the entries of the dirty tests up to date with the artifacts"""
+        with self._lock:
+            if self._all_dirty:
+                for name in [name for name in self.entries if name not in artifacts]:
+                    self.remove(name)
+                names = list(artifacts)
+            else:
+                names = self._dirty
+            self._all_dirty = False
+            self._dirty = set()
+            stale = []
+            for name in names:
+                test = artifacts.get(name)
+                if test is None or not test.get("statuses"):
+                    self.remove(name)
+                    continue
+                fingerprint = self._fingerprint(test)
+                if name not in self.entries or self._fingerprints.get(name) != fingerprint:
+                    stale.append((name, test, fingerprint))
+            self.side_files.prefetch(
+                file_dict for _, test, _ in stale for file_dict in test.get("files") or ()
+            )
+            for name, test, fingerprint in stale:
+                self._rebuild(name, test, fingerprint)
+            now = time.time()
+            for name in self._in_progress:
+                test = artifacts.get(name)
+                if test is not None:
+                    self.tree.retime(self.entries[name], now - test["start_time"])
+
+    @staticmethod
+    def _fingerprint(test):
+        # This was removed previously but is needed as the overall is not generated
+        # until the test finishes. So this is here as a shim.
+        test["statuses"]["overall"] = overall_test_status(test["statuses"])
+        return _fingerprint(test)
+
+    def update(self, name, test):
+        """Brings the entry of a test up to date with its record"""
+        if not test.get("statuses"):
+            self.remove(name)
+            return
+        with self._lock:
+            fingerprint = self._fingerprint(test)
+            if name not in self.entries or self._fingerprints.get(name) != fingerprint:
+                self._rebuild(name, test, fingerprint)
+
+    def _rebuild(self, name, test, fingerprint):
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                self._account(entry, -1)
+            new_entry = self.entries[name] = self.build_entry(name, test)
+            self._fingerprints[name] = fingerprint
+            self._account(new_entry, 1)
+            if new_entry.get("in_progress"):
+                self._in_progress.add(name)
+            else:
+                self._in_progress.discard(name)
+            if entry is None:
+                self.tree.add(new_entry)
+            else:
+                self.tree.replace(entry, new_entry)
+
+    def remove(self, name):
+        with self._lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                del self._fingerprints[name]
+                self._in_progress.discard(name)
+                self._account(entry, -1)
+                self.tree.remove(entry)
+
+    def invalidate(self, name, filenames=()):
+        """Builds the entry of a test again on the next refresh, rereading ``filenames``"""
+        with self._lock:
+            self._dirty.add(name)
+            self._fingerprints.pop(name, None)
+            for filename in filenames:
+                self.side_files.forget(filename)
+
+    def _account(self, entry, sign):
+        status = entry["outcomes"]["overall"]
+        self.counts[status] += sign
+        if not entry.get("old", False):
+            self.current_counts[status] += sign
+        for skip_type in ("blocker", "provider"):
+            if f"skip_{skip_type}" in entry:
+                self.skip_counts[skip_type] += sign
+        for contact in dict.fromkeys(qacontact[0] for qacontact in entry["qa_contact"]):
+            self.qa[contact] = self.qa.get(contact, 0) + sign
+            if not self.qa[contact]:
+                del self.qa[contact]
+
+    def build_entry(self, test_name, test):
+        overall_status = test["statuses"]["overall"]
+        test_data = {
+            "name": test_name,
+            # a copy, the counts are taken back by the status the entry was built with
+            "outcomes": dict(test["statuses"]),
+            "slaveid": test.get("slaveid", "Unknown"),
+            "color": STATUS_COLORS[overall_status],
+        }
+        if "composite" in test:
+            test_data["composite"] = test["composite"]
+
+        if "skipped" in test:
+            if test["skipped"].get("type") == "provider":
+                test_data["skip_provider"] = test["skipped"].get("reason")
+            if test["skipped"].get("type") == "blocker":
+                # Fix the inconveniently long list of repeated blockers until we sort out sets
+                # in riggerlib somehow.
+                test_data["skip_blocker"] = sorted(set(test["skipped"].get("reason")))
+
+        if test.get("old", False):
+            test_data["old"] = True
+
+        if test.get("start_time"):
+            if test.get("finish_time"):
+                test_data["in_progress"] = False
+                test_data["seconds"] = test["finish_time"] - test["start_time"]
+            else:
+                test_data["seconds"] = time.time() - test["start_time"]
+                test_data["in_progress"] = True
+            if test_data["seconds"]:
+                test_data["duration"] = pretty_duration(test_data["seconds"])
+            else:
+                test_data["duration"] = test_data["seconds"]
+
+        # Set up destinations for the files
+        test_data["file_groups"] = []
+        test_data["qa_contact"] = []
+        urls = []
+        processed_groups = {}
+        order = 0
+        for file_dict in test.get("files", []):
+            group = file_dict["group_id"]
+            if group not in processed_groups:
+                processed_groups[group] = (order, [])
+                order += 1
+            processed_groups[group][-1].append(file_dict)
+        # Current structure:
+        # {groupid: (group_order, [{filedict1}, {filedict2}])}
+        # Sorting by group_order
+        processed_groups = sorted(processed_groups.items(), key=lambda kv: kv[1][0])
+        # And now make it [(groupid, [{filedict1}, {filedict2}, ...])]
+        processed_groups = [(group_name, files) for group_name, (_, files) in processed_groups]
+        for group_name, file_dicts in processed_groups:
+            group_file_list = []
+            for file_dict in file_dicts:
+                if file_dict["file_type"] in self.side_files.types:
+                    try:
+                        content = self.side_files.read(
+                            file_dict["file_type"], file_dict["os_filename"]
+                        )
+                    except OSError:
+                        # not written yet, look at the test again on the next refresh
+                        self._dirty.add(test_name)
+                        continue
+                if file_dict["file_type"] == "qa_contact":
+                    test_data["qa_contact"].extend(content)
+                    continue  # Do not store, handled a different way :)
+                elif file_dict["file_type"] == "short_tb":
+                    short_tb, urls, truncated = content
+                    test_data["short_tb"] = short_tb
+                    if truncated:
+                        test_data["short_tb_file"] = file_dict["os_filename"].replace(
+                            self.log_dir, ""
+                        )
+                    continue
+                file_dict["filename"] = file_dict["os_filename"].replace(self.log_dir, "")
+                group_file_list.append(file_dict)
+
+            # Leave out groups that are left empty because of eg. traceback or qa contact
+            if group_file_list:
+                test_data["file_groups"].append((group_name, group_file_list))
+        if urls:
+            test_data["urls"] = urls
+        return test_data
+
+
 class ReporterBase(object):
     def _run_report(
         self, old_artifacts, artifact_dir, run_type, run_id, version=None, fw_version=None
     ):
-        if run_type == "run" and run_id:
-            dir = str(os.path.join(artifact_dir, run_id))
-        else:
-            dir = artifact_dir
+        dir = report_dir(artifact_dir, run_type, run_id)
         template_data = self.process_data(old_artifacts, dir, version, fw_version)
 
         if hasattr(self, "only_failed") and self.only_failed:
@@ -72,137 +613,129 @@ class ReporterBase(object):
                 x for x in template_data["tests"] if x["outcomes"]["overall"] not in ["passed"]
             ]
 
-        self.render_report(template_data, "report", dir, "test_report.html")
+        formats = getattr(self, "formats", ["html"])
+        if "json" in formats:
+            compression = getattr(self, "json_compression", None)
+            self.export_report(template_data, "report", dir, compression)
+        if "html" in formats:
+            if getattr(self, "sharded", False):
+                self.render_sharded_report(template_data, "report", dir, "test_report.html")
+            else:
+                self.render_report(template_data, "report", dir, "test_report.html")
+
+    def export_report(self, report, filename, log_dir, compression=None):
+        """
+        Writes the report data as compact json to ``filename``.json, in a single streaming
+        pass, and puts the viewer rendering it next to it
+        """
+        data = {key: value for key, value in report.items() if key not in ("ndata", "tree")}
+        export = f"{filename}.json"
+        if compression:
+            export += COMPRESSION_SUFFIXES[compression]
+        encoder = json.JSONEncoder(separators=(",", ":"), default=str, check_circular=False)
+        # rendered to a temporary file first, with the suffix open_artifact compresses by
+        tmp = os.path.join(log_dir, f".{export}")
+        with open_artifact(tmp, "w", encoding="utf-8") as f:
+            for chunk in encoder.iterencode(data):
+                f.write(chunk)
+        os.replace(tmp, os.path.join(log_dir, export))
+        viewer = os.path.join(log_dir, VIEWER)
+        if viewer not in _deployed_assets:
+            shutil.copyfile(str(TEMPLATE_PATH / VIEWER), viewer)
+            _deployed_assets.add(viewer)
+
+    def render_sharded_report(self, report, filename, log_dir, template):
+        """
+        Renders a page for every top-level module of the tree, holding its tests and its part
+        of the tree, one page after the other. Modules which are the only module in their
+        parent, like ``tests``, are stepped through first, so the modules below them are the
+        ones paged. ``filename``.html is an index linking to the pages, with the counts of
+        the run and the tests which are in none of the paged modules.
+        """
+        node = report["tree"].root
+        prefix = []
+        while True:
+            modules = [(k, v) for k, v in node.sub.items() if isinstance(v, ModuleNode)]
+            if len(modules) != 1:
+                break
+            [(key, node)] = modules
+            prefix.append(key)
+        depth = len(prefix)
+        shards = {key: [] for key, sub in node.sub.items() if isinstance(sub, ModuleNode)}
+        loose = []
+        for test in report["tests"]:
+            path = _tree_path(test)
+            # the levels stepped through hold a single module, so this is under the prefix
+            if len(path) > depth + 1 and path[depth] in shards:
+                shards[path[depth]].append(test)
+            else:
+                loose.append(test)
+        pages = {}
+        for key, tests in shards.items():
+            if not any(node.sub[key].counts):
+                continue
+            label = "/".join(prefix + [key])
+            page = "{}-{}".format(filename, re.sub(r"[^\w.-]", "_", label))
+            while page in pages.values():
+                page += "_"
+            pages[key] = page
+            shard_tree = ModuleNode()
+            shard_tree.sub[label] = node.sub[key]
+            shard = dict(report, tests=tests, ndata=self.iter_li(shard_tree))
+            self.render_report(shard, page, log_dir, template)
+        ndata = self.iter_shard_li(node, pages, prefix, loose)
+        index = dict(report, tests=loose, ndata=ndata)
+        self.render_report(index, filename, log_dir, template)
 
     def render_report(self, report, filename, log_dir, template):
-        template_env = Environment(loader=FileSystemLoader(str(TEMPLATE_PATH)))
-        data = template_env.get_template(template).render(**report)
+        """
+        Renders the report into ``filename``.html in pieces, the page is never held in memory
+        as a whole. It is rendered to a temporary file first, so the report in place stays
+        whole while the next one renders.
+        """
+        env = template_env(getattr(self, "bytecode_cache", None))
+        stream = env.get_template(template).stream(**report)
+        stream.enable_buffering(RENDER_BUFFER)
+        report_file = os.path.join(log_dir, f"{filename}.html")
+        stream.dump(f"{report_file}.tmp", encoding="utf-8")
+        os.replace(f"{report_file}.tmp", report_file)
+        deploy_assets(log_dir, getattr(self, "assets", "copy"))
+
+    def report_model(self, log_dir):
+        """Returns the model of the report written to ``log_dir``, kept between reports"""
+        if not hasattr(self, "_report_models"):
+            self._report_models = {}
+        log_dir = str(Path(log_dir))
+        model = self._report_models.get(log_dir)
+        if model is None:
+            if not hasattr(self, "_side_files"):
+                self._side_files = SideFiles(
+                    getattr(self, "read_workers", 8), getattr(self, "tb_preview", None)
+                )
+            model = self._report_models.setdefault(log_dir, ReportModel(log_dir, self._side_files))
+        return model
 
-        with open(os.path.join(log_dir, f"{filename}.html"), "w") as f:
-            f.write(data)
-        try:
-            shutil.copytree(str(TEMPLATE_PATH / "dist"), os.path.join(log_dir, "dist"))
-        except OSError:
-            pass
+    def mark_dirty(self, test_ident=None):
+        """Marks a test, or all of them, to be looked at again by the models of all reports"""
+        for model in getattr(self, "_report_models", {}).values():
+            if test_ident is None:
+                model.mark_all()
+            else:
+                model.mark(test_ident)
 
     def process_data(self, artifacts, log_dir, version, fw_version, name_filter=None):
-        blocker_skip_count = 0
-        provider_skip_count = 0
-        template_data = {"tests": [], "qa": []}
-        template_data["version"] = version
-        template_data["fw_version"] = fw_version
-        log_dir = str(Path(log_dir)) + "/"
-        counts = {"passed": 0, "failed": 0, "skipped": 0, "error": 0, "xfailed": 0, "xpassed": 0}
-        current_counts = {
-            "passed": 0,
-            "failed": 0,
-            "skipped": 0,
-            "error": 0,
-            "xfailed": 0,
-            "xpassed": 0,
-        }
-        colors = {
-            "passed": "success",
-            "failed": "warning",
-            "error": "danger",
-            "xpassed": "danger",
-            "xfailed": "success",
-            "skipped": "info",
+        model = self.report_model(log_dir)
+        model.refresh(artifacts)
+        template_data = {
+            "tests": [model.entries[name] for name in artifacts if name in model.entries],
+            "qa": list(model.qa),
+            "version": version,
+            "fw_version": fw_version,
+            "counts": dict(model.counts),
+            "current_counts": dict(model.current_counts),
+            "blocker_skip_count": model.skip_counts["blocker"],
+            "provider_skip_count": model.skip_counts["provider"],
         }
-        # Iterate through the tests and process the counts and durations
-        for test_name, test in artifacts.items():
-            if not test.get("statuses"):
-                continue
-            overall_status = overall_test_status(test["statuses"])
-            counts[overall_status] += 1
-            if not test.get("old", False):
-                current_counts[overall_status] += 1
-            color = colors[overall_status]
-            # This was removed previously but is needed as the overall is not generated
-            # until the test finishes. So this is here as a shim.
-            test["statuses"]["overall"] = overall_status
-            test_data = {
-                "name": test_name,
-                "outcomes": test["statuses"],
-                "slaveid": test.get("slaveid", "Unknown"),
-                "color": color,
-            }
-            if "composite" in test:
-                test_data["composite"] = test["composite"]
-
-            if "skipped" in test:
-                if test["skipped"].get("type") == "provider":
-                    provider_skip_count += 1
-                    test_data["skip_provider"] = test["skipped"].get("reason")
-                if test["skipped"].get("type") == "blocker":
-                    blocker_skip_count += 1
-                    test_data["skip_blocker"] = test["skipped"].get("reason")
-
-            if "skip_blocker" in test_data:
-                # Fix the inconveniently long list of repeated blockers until we sort out sets
-                # in riggerlib somehow.
-                test_data["skip_blocker"] = sorted(set(test_data["skip_blocker"]))
-
-            if test.get("old", False):
-                test_data["old"] = True
-
-            if test.get("start_time"):
-                if test.get("finish_time"):
-                    test_data["in_progress"] = False
-                    test_data["duration"] = test["finish_time"] - test["start_time"]
-                else:
-                    test_data["duration"] = time.time() - test["start_time"]
-                    test_data["in_progress"] = True
-
-            # Set up destinations for the files
-            test_data["file_groups"] = []
-            test_data["qa_contact"] = []
-            processed_groups = {}
-            order = 0
-            for file_dict in test.get("files", []):
-                group = file_dict["group_id"]
-                if group not in processed_groups:
-                    processed_groups[group] = (order, [])
-                    order += 1
-                processed_groups[group][-1].append(file_dict)
-            # Current structure:
-            # {groupid: (group_order, [{filedict1}, {filedict2}])}
-            # Sorting by group_order
-            processed_groups = sorted(processed_groups.items(), key=lambda kv: kv[1][0])
-            # And now make it [(groupid, [{filedict1}, {filedict2}, ...])]
-            processed_groups = [(group_name, files) for group_name, (_, files) in processed_groups]
-            for group_name, file_dicts in processed_groups:
-                group_file_list = []
-                for file_dict in file_dicts:
-                    if file_dict["file_type"] == "qa_contact":
-                        with open(file_dict["os_filename"], "rb") as qafile:
-                            qareader = csv.reader(qafile, delimiter=",", quotechar='"')
-                            for qacontact in qareader:
-                                test_data["qa_contact"].append(qacontact)
-                                if qacontact[0] not in template_data["qa"]:
-                                    template_data["qa"].append(qacontact[0])
-                        continue  # Do not store, handled a different way :)
-                    elif file_dict["file_type"] == "short_tb":
-                        with open(file_dict["os_filename"], "r") as short_tb:
-                            test_data["short_tb"] = short_tb.read()
-                        continue
-                    file_dict["filename"] = file_dict["os_filename"].replace(log_dir, "")
-                    group_file_list.append(file_dict)
-
-                test_data["file_groups"].append((group_name, group_file_list))
-            # Snd remove groups that are left empty because of eg. traceback or qa contact
-            test_data["file_groups"] = filter(
-                lambda group: len(group[1]) > 0, test_data["file_groups"]
-            )
-            if "short_tb" in test_data and test_data["short_tb"]:
-                urls = [url for url in URL.findall(test_data["short_tb"])]
-                if urls:
-                    test_data["urls"] = urls
-            template_data["tests"].append(test_data)
-        template_data["counts"] = counts
-        template_data["current_counts"] = current_counts
-        template_data["blocker_skip_count"] = blocker_skip_count
-        template_data["provider_skip_count"] = provider_skip_count
 
         if name_filter:
             template_data["tests"] = [
@@ -210,116 +743,93 @@ class ReporterBase(object):
                 for x in template_data["tests"]
                 if re.findall(r"{}[-\]]+".format(name_filter), x["name"])  # Valid use of .format
             ]
+            # Create the tree dict that is used for js tree, of the filtered tests only
+            tests = ModuleTree()
+            for test in template_data["tests"]:
+                tests.add(test)
+        else:
+            tests = model.tree
 
-        # Create the tree dict that is used for js tree
-        # Note template_data['tests'] != tests
-        tests = deepcopy(_tests_tpl)
-        tests["_sub"]["tests"] = deepcopy(_tests_tpl)
-
-        for test in template_data["tests"]:
-            self.build_dict(test["name"].replace("iqe/", ""), tests, test)
-
-        template_data["ndata"] = self.build_li(tests)
-
-        for test in template_data["tests"]:
-            if test.get("duration"):
-                test["duration"] = str(datetime.timedelta(seconds=math.ceil(test["duration"])))
-
+        template_data["tree"] = tests
+        template_data["ndata"] = self.iter_li(tests.root)
         return template_data
 
-    def build_dict(self, path, container, contents):
+    def build_li(self, lev):
         """
-        Build a hierarchical dictionary including information about the stats at each level
-        and the duration.
+        Build up the actual HTML tree from a module of the ModuleTree of the ReportModel
         """
+        return "".join(self.iter_li(lev))
 
-        if isinstance(path, str):
-            segs = process_pytest_path(path)
-        else:
-            segs = path
-
-        head = segs[0]
-        end = segs[1:]
-
-        # If we are at the end node, ie a test.
-        if not end:
-            container["_sub"][head] = contents
-            container["_stats"][contents["outcomes"]["overall"]] += 1
-            container["_duration"] += contents["duration"]
-        # If we are in a module.
-        else:
-            if head not in container["_sub"]:
-                container["_sub"][head] = deepcopy(_tests_tpl)
-            # Call again to recurse down the tree.
-            self.build_dict(end, container["_sub"][head], contents)
-            container["_stats"][contents["outcomes"]["overall"]] += 1
-            container["_duration"] += contents["duration"]
+    def iter_li(self, lev):
+        """
+        Like build_li, but yields the HTML tree in pieces, walking the module tree without
+        recursion
+        """
+        yield "<ul>\n"
+        # the children of the modules being walked, with what closes their list item
+        stack = [(iter(lev.sub.items()), "")]
+        while stack:
+            for k, v in stack[-1][0]:
+                # Modules have other modules or tests to go, anything else is a test (leaf).
+                if isinstance(v, ModuleNode):
+                    head, tail = self._module_label(k, v)
+                    yield "<li>" + head
+                    yield "<ul>\n"
+                    stack.append((iter(v.sub.items()), tail + "</li>\n"))
+                    break
+                yield self._test_li(k, v)
+            else:
+                yield "</ul>\n"
+                yield stack.pop()[1]
+
+    def _test_li(self, k, v):
+        pretty_time = pretty_duration(v.get("seconds", 0))
+        teststring = '<span name="mod_lev" class="label label-primary">T</span>'
+        label = '<span class="label label-{}">{}</span>'.format(
+            TREE_LABELS[v["outcomes"]["overall"]], v["outcomes"]["overall"].upper()
+        )
+        # The key of a test in the tree already is the last segment of its path
+        link = (
+            '<a href="#{}">{} {} {} <span style="color:#888888">'
+            "<em>[{}]</em></span></a>".format(v["name"], k, teststring, label, pretty_time)
+        )
+        return "<li>{}</li>\n".format(link)
 
-    def build_li(self, lev):
+    def iter_shard_li(self, lev, pages, prefix=(), loose=()):
         """
-        Build up the actual HTML tree from the dict from build_dict
+        Yields the HTML tree of the index of a sharded report, linking the shard pages of the
+        modules of ``lev``, followed by the ``loose`` tests which are in none of them
         """
-        bimdict = {
-            "passed": "success",
-            "failed": "warning",
-            "error": "danger",
-            "skipped": "primary",
-            "xpassed": "danger",
-            "xfailed": "success",
-        }
-        list_string = "<ul>\n"
-        for k, v in lev["_sub"].items():
-
-            # If 'name' is an attribute then we are looking at a test (leaf).
-            if "name" in v:
-                pretty_time = str(datetime.timedelta(seconds=math.ceil(v["duration"])))
-                teststring = '<span name="mod_lev" class="label label-primary">T</span>'
-                label = '<span class="label label-{}">{}</span>'.format(
-                    bimdict[v["outcomes"]["overall"]], v["outcomes"]["overall"].upper()
-                )
-                proc_name = process_pytest_path(v["name"])[-1]
-                link = (
-                    '<a href="#{}">{} {} {} <span style="color:#888888">'
-                    "<em>[{}]</em></span></a>".format(
-                        v["name"], proc_name, teststring, label, pretty_time
-                    )
-                )
-                # Do we really need the os.path.split (now process_pytest_path) here?
-                # For me it seems the name is always the leaf
-                list_string += "<li>{}</li>\n".format(link)
-
-            # If there is a '_sub' attribute then we know we have other modules to go.
-            elif "_sub" in v:
-                percenstring = ""
-                bmax = 0
-                for _, val in v["_stats"].items():
-                    bmax += val
-                # If there were any NON skipped tests, we now calculate the percentage which
-                # passed.
-                if bmax:
-                    percen = "{:.2f}".format(
-                        (float(v["_stats"]["passed"]) + float(v["_stats"]["xfailed"]))
-                        / float(bmax)
-                        * 100
-                    )
-                    if float(percen) == 100.0:
-                        level = "passed"
-                    elif float(percen) > 80.0:
-                        level = "failed"
-                    else:
-                        level = "error"
-                    percenstring = '<span name="blab" class="label label-{}">{}%</span>'.format(
-                        bimdict[level], percen
-                    )
-                modstring = '<span name="mod_lev" class="label label-primary">M</span>'
-                pretty_time = str(datetime.timedelta(seconds=math.ceil(v["_duration"])))
-                list_string += (
-                    "<li>{} {}<span>&nbsp;</span>"
-                    '{}{}<span style="color:#888888">&nbsp;<em>[{}]'
-                    "</em></span></li>\n"
-                ).format(k, modstring, str(percenstring), self.build_li(v), pretty_time)
-        list_string += "</ul>\n"
-        return list_string
+        yield "<ul>\n"
+        for k, page in pages.items():
+            head, tail = self._module_label("/".join([*prefix, k]), lev.sub[k])
+            yield '<li><a href="{}.html">{}{}</a></li>\n'.format(page, head, tail)
+        for test in loose:
+            yield self._test_li("/".join(_tree_path(test)), test)
+        yield "</ul>\n"
+
+    def _module_label(self, k, v):
+        """Returns the label of a module, the parts before and after the list of its children"""
+        percenstring = ""
+        percentage = v.pass_percentage()
+        # If there were any tests, we now show the percentage which passed.
+        if percentage is not None:
+            percen = "{:.2f}".format(percentage)
+            if float(percen) == 100.0:
+                level = "passed"
+            elif float(percen) > 80.0:
+                level = "failed"
+            else:
+                level = "error"
+            percenstring = '<span name="blab" class="label label-{}">{}%</span>'.format(
+                TREE_LABELS[level], percen
+            )
+        modstring = '<span name="mod_lev" class="label label-primary">M</span>'
+        pretty_time = pretty_duration(v.duration)
+        return (
+            "{} {}<span>&nbsp;</span>{}".format(k, modstring, percenstring),
+            '<span style="color:#888888">&nbsp;<em>[{}]</em></span>'.format(pretty_time),
+        )
 
 
 class Reporter(ArtifactorBasePlugin, ReporterBase):
@@ -333,57 +843,66 @@ class Reporter(ArtifactorBasePlugin, ReporterBase):
         self.register_plugin_hook("session_info", self.session_info)
         self.register_plugin_hook("composite_pump", self.composite_pump)
         self.register_plugin_hook("tb_info", self.tb_info)
+        self.register_plugin_hook("sanitize", self.sanitize)
+        self.register_plugin_hook("filedump", self.file_added)
+        self.register_plugin_hook("filedump_close", self.file_added)
 
     def configure(self):
         self.only_failed = self.data.get("only_failed", False)
+        self.assets = self.data.get("assets", "copy")
+        self.bytecode_cache = self.data.get("bytecode_cache")
+        self.sharded = self.data.get("sharded", False)
+        self.formats = self.data.get("formats", ["html"])
+        self.json_compression = self.data.get("json_compression")
+        # the viewer decompresses the export in the browser, browsers only speak gzip
+        if self.json_compression not in (None, "gzip"):
+            raise ValueError(
+                "reporter {}: json_compression must be gzip, not {!r}".format(
+                    self.ident, self.json_compression
+                )
+            )
+        self.read_workers = self.data.get("read_workers", 8)
+        self.tb_preview = self.data.get("tb_preview")
         self.configured = True
 
     @ArtifactorBasePlugin.check_configured
     def composite_pump(self, old_artifacts):
+        self.mark_dirty()
         return None, {"old_artifacts": old_artifacts}
 
     @ArtifactorBasePlugin.check_configured
-    def skip_test(self, test_location, test_name, skip_data):
+    def skip_test(self, artifacts, test_location, test_name, skip_data):
         test_ident = "{}/{}".format(test_location, test_name)
-        return None, {"artifacts": {test_ident: {"skipped": skip_data}}}
+        artifacts.set(test_ident, skipped=skip_data)
+        self.mark_dirty(test_ident)
 
     @ArtifactorBasePlugin.check_configured
-    def start_test(self, test_location, test_name, metadata=None, param_dict=None, slaveid=None):
+    def start_test(
+        self, artifacts, test_location, test_name, metadata=None, param_dict=None, slaveid=None
+    ):
         if not param_dict:
             param_dict = {}
         test_ident = "{}/{}".format(test_location, test_name)
-        return (
-            None,
-            {
-                "artifacts": {
-                    test_ident: {
-                        "start_time": time.time(),
-                        "slaveid": slaveid,
-                        "metadata": metadata,
-                        "params": param_dict,
-                        "test_module": test_location,
-                        "test_name": test_name,
-                    }
-                }
-            },
+        artifacts.set(
+            test_ident,
+            start_time=time.time(),
+            slaveid=slaveid,
+            metadata=metadata,
+            params=param_dict,
+            test_module=test_location,
+            test_name=test_name,
         )
+        # filedump adds the files of a slave to the test it started last
+        self.store[slaveid or "Master"] = test_ident
+        self.mark_dirty(test_ident)
 
     @ArtifactorBasePlugin.check_configured
     def finish_test(self, artifacts, test_location, test_name, slaveid=None):
         test_ident = "{}/{}".format(test_location, test_name)
         overall_status = overall_test_status(artifacts[test_ident]["statuses"])
-        return (
-            None,
-            {
-                "artifacts": {
-                    test_ident: {
-                        "finish_time": time.time(),
-                        "slaveid": slaveid,
-                        "statuses": {"overall": overall_status},
-                    }
-                }
-            },
-        )
+        artifacts.set(test_ident, finish_time=time.time(), slaveid=slaveid)
+        artifacts.set_item(test_ident, "statuses", "overall", overall_status)
+        self.mark_dirty(test_ident)
 
     @ArtifactorBasePlugin.check_configured
     def report_test(
@@ -397,15 +916,10 @@ class Reporter(ArtifactorBasePlugin, ReporterBase):
         test_phase_duration,
     ):
         test_ident = "{}/{}".format(test_location, test_name)
-        ret_dict = {
-            "artifacts": {
-                test_ident: {
-                    "statuses": {test_when: (test_outcome, test_xfail)},
-                    "durations": {test_when: test_phase_duration},
-                }
-            }
-        }
-        return None, ret_dict
+        status = (sys.intern(test_outcome), test_xfail)
+        artifacts.set_item(test_ident, "statuses", test_when, status)
+        artifacts.set_item(test_ident, "durations", test_when, test_phase_duration)
+        self.mark_dirty(test_ident)
 
     @ArtifactorBasePlugin.check_configured
     def session_info(self, version=None, build=None, stream=None, fw_version=None):
@@ -415,22 +929,33 @@ class Reporter(ArtifactorBasePlugin, ReporterBase):
         )
 
     @ArtifactorBasePlugin.check_configured
-    def tb_info(self, test_location, test_name, exception, file_line, short_tb):
+    def tb_info(self, artifacts, test_location, test_name, exception, file_line, short_tb):
         test_ident = "{}/{}".format(test_location, test_name)
-        return (
-            None,
-            {
-                "artifacts": {
-                    test_ident: {
-                        "exception": {
-                            "file_line": file_line,
-                            "exception": exception,
-                            "short_tb": short_tb,
-                        }
-                    }
-                }
-            },
+        artifacts.set(
+            test_ident,
+            exception={"file_line": file_line, "exception": exception, "short_tb": short_tb},
         )
+        self.mark_dirty(test_ident)
+
+    @ArtifactorBasePlugin.check_configured
+    def file_added(self, slaveid=None):
+        test_ident = self.store.get(slaveid or "Master")
+        if test_ident is not None:
+            self.mark_dirty(test_ident)
+
+    @ArtifactorBasePlugin.check_configured
+    def sanitize(self, artifacts, test_location, test_name):
+        """
+        The side files of the test are rewritten, possibly within the resolution of their
+        mtime, so its entry is built from them again
+        """
+        test_ident = "{}/{}".format(test_location, test_name)
+        filenames = [
+            file_dict["os_filename"]
+            for file_dict in artifacts.get(test_ident, {}).get("files") or ()
+        ]
+        for model in getattr(self, "_report_models", {}).values():
+            model.invalidate(test_ident, filenames)
 
     @ArtifactorBasePlugin.check_configured
     def run_report(
@@ -0,0 +1,88 @@
+import os
+import re
+
+from iqe.artifactor.utils import open_artifact
+
+
+class Redactor(object):
+    """Replaces a set of words by asterisks of the same length, in a single pass
+
+    The words are compiled into one regular expression, longest words first, so where words
+    overlap the longest one is redacted.
+
+    Args:
+        words: The words to redact, anything that is not a string is redacted as its str.
+    """
+
+    def __init__(self, words, chunk_size=1 << 20):
+        words = {word if isinstance(word, str) else str(word) for word in words}
+        self.words = sorted(filter(None, words), key=len, reverse=True)
+        self.chunk_size = chunk_size
+        # the part of a chunk a match starting before it may reach into
+        self.overlap = max(map(len, self.words), default=1) - 1
+        self._pattern = re.compile("|".join(map(re.escape, self.words))) if self.words else None
+
+    @staticmethod
+    def _mask(match):
+        return "*" * (match.end() - match.start())
+
+    def redact(self, text):
+        """Returns the redacted text"""
+        if self._pattern is None:
+            return text
+        return self._pattern.sub(self._mask, text)
+
+    def _chunks(self, f):
+        """Yields the chunks of a file, each with the ``overlap`` preceding it"""
+        carry = ""
+        while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                return
+            yield carry, chunk
+            carry = (carry + chunk)[-self.overlap :] if self.overlap else ""
+
+    def matches_file(self, filename):
+        """Returns whether any word occurs in a file"""
+        if self._pattern is None:
+            return False
+        with open_artifact(filename) as f:
+            return any(self._pattern.search(carry + chunk) for carry, chunk in self._chunks(f))
+
+    def redact_file(self, filename):
+        """Redacts a file, returns whether anything was redacted
+
+        The file is only read in chunks, and only rewritten if a word occurs in it. The
+        rewritten file replaces the original one, it is not written in place.
+        """
+        if not self.matches_file(filename):
+            return False
+        head, tail = os.path.split(filename)
+        redacted = os.path.join(head, ".sanitized-" + tail)
+        with open_artifact(filename) as src, open_artifact(redacted, "w") as dst:
+            carry = ""
+            while True:
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    dst.write(self.redact(carry))
+                    break
+                carry = self._redact_head(carry + chunk, dst.write)
+        os.replace(redacted, filename)
+        return True
+
+    def _redact_head(self, text, write):
+        """
+        Writes out the redacted text but its last ``overlap`` characters, a word may still
+        continue there, and returns the rest
+        """
+        cut = len(text) - self.overlap
+        pos = 0
+        for match in self._pattern.finditer(text):
+            if match.start() >= cut:
+                break
+            write(text[pos : match.start()])
+            write(self._mask(match))
+            pos = match.end()
+        cut = max(cut, pos)
+        write(text[pos:cut])
+        return text[cut:]
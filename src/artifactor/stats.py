@@ -0,0 +1,155 @@
+"""
+Instrumentation of the event dispatch of the Artifactor server
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from iqe.artifactor.metrics import Histogram
+from iqe.artifactor.metrics import Registry
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    float("inf"),
+)
+SIZE_BUCKETS = tuple(float(1 << shift) for shift in range(6, 27, 2)) + (float("inf"),)
+
+
+def callback_name(call):
+    """Names a callback or plugin hook, plugin hooks by the ident of their plugin"""
+    ident = getattr(getattr(call, "__self__", None), "ident", None)
+    if ident is not None:
+        return ident
+    return getattr(call, "__name__", repr(call))
+
+
+class DispatchStats(object):
+    """Latency histograms of the events, and of the callbacks and plugin hooks they run
+
+    The event a callback runs for is tracked per thread, so the stats work alike with events
+    dispatched one after the other and concurrently in lanes.
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.queue_wait = self.registry.register(
+            Histogram(
+                "artifactor_queue_wait_seconds",
+                "Time events waited to be processed",
+                ["event"],
+                LATENCY_BUCKETS,
+            )
+        )
+        self.events = self.registry.register(
+            Histogram(
+                "artifactor_event_seconds",
+                "Time spent processing events",
+                ["event"],
+                LATENCY_BUCKETS,
+            )
+        )
+        self.callbacks = self.registry.register(
+            Histogram(
+                "artifactor_callback_seconds",
+                "Time spent in the callbacks and plugin hooks of events",
+                ["event", "callback"],
+                LATENCY_BUCKETS,
+            )
+        )
+        self.merges = self.registry.register(
+            Histogram(
+                "artifactor_merge_seconds",
+                "Time spent merging the updates of callbacks and plugin hooks",
+                ["event"],
+                LATENCY_BUCKETS,
+            )
+        )
+        self.message_bytes = self.registry.register(
+            Histogram(
+                "artifactor_message_bytes",
+                "Sizes of the messages received",
+                ["channel"],
+                SIZE_BUCKETS,
+            )
+        )
+        self._local = threading.local()
+
+    @property
+    def current_event(self):
+        return getattr(self._local, "event", None) or "background"
+
+    @contextmanager
+    def event(self, hook_name):
+        """Times an event, callbacks run meanwhile on this thread are accounted to it"""
+        outer = getattr(self._local, "event", None)
+        self._local.event = hook_name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.events.observe(time.monotonic() - start, hook_name)
+            self._local.event = outer
+
+    @contextmanager
+    def timed(self, histogram, *labelvalues):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            histogram.observe(time.monotonic() - start, *labelvalues)
+
+    def summary(self):
+        """Returns count, total and estimated percentiles of every event and callback"""
+        summary = {}
+        for name, histogram in (
+            ("events", self.events),
+            ("callbacks", self.callbacks),
+            ("queue_wait", self.queue_wait),
+            ("merges", self.merges),
+            ("message_bytes", self.message_bytes),
+        ):
+            summary[name] = {
+                "/".join(labelvalues): {
+                    "count": sum(counts),
+                    "total": total,
+                    "p50": _quantile(histogram.buckets, counts, 0.5),
+                    "p95": _quantile(histogram.buckets, counts, 0.95),
+                }
+                for labelvalues, (counts, total) in histogram.snapshot().items()
+            }
+        return summary
+
+    def format_summary(self):
+        lines = ["dispatch stats, percentiles are bucket bounds:"]
+        for name, entries in self.summary().items():
+            for key, entry in sorted(entries.items(), key=lambda item: -item[1]["total"]):
+                lines.append(
+                    "  {} {}: {count} x, total {total:.3f}, p50 <= {p50}, p95 <= {p95}".format(
+                        name, key, **entry
+                    )
+                )
+        return "\n".join(lines)
+
+
+def _quantile(buckets, counts, q):
+    """Returns the upper bound of the bucket the ``q`` quantile of the observations falls in"""
+    rank = q * sum(counts)
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return buckets[-1]
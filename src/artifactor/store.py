@@ -0,0 +1,183 @@
+import copy
+import sys
+import threading
+from collections.abc import MutableMapping
+
+
+class TestRecord(MutableMapping):
+    """The artifacts collected for a single test
+
+    The fields every test gets live in slots, anything else plugins put into a record goes into
+    an extra dict, so the record can be used like the dict it replaces.
+    """
+
+    FIELDS = (
+        "test_module",
+        "test_name",
+        "slaveid",
+        "start_time",
+        "finish_time",
+        "metadata",
+        "params",
+        "statuses",
+        "durations",
+        "files",
+        "skipped",
+        "exception",
+        "composite",
+        "old",
+    )
+    __slots__ = FIELDS + ("_extra",)
+
+    _field_set = frozenset(FIELDS)
+    _interned = frozenset({"test_module", "slaveid"})
+
+    def __init__(self, data=()):
+        self._extra = None
+        for key, value in dict(data).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            if key in self._interned and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+
+class ArtifactStore(MutableMapping):
+    """The ``artifacts`` global data, mapping ``"{test_location}/{test_name}"`` to a TestRecord
+
+    Plugins write to it through the path addressed methods instead of returning nested dicts
+    that have to be merged into the global data. Merging such dicts the old way still works,
+    as the store and its records behave like the nested dicts they replace.
+
+    If ``journal`` is set, every write through these methods is appended to it.
+    """
+
+    journal = None
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def record(self, test_ident):
+        """Returns the record of a test, creating it if the test has none yet"""
+        try:
+            return self._records[test_ident]
+        except KeyError:
+            with self._lock:
+                return self._records.setdefault(sys.intern(test_ident), TestRecord())
+
+    def set(self, test_ident, **fields):
+        """Sets fields of a test's record"""
+        if self.journal is not None:
+            self.journal.append("artifact", "set", (test_ident,), fields)
+        record = self.record(test_ident)
+        for field, value in fields.items():
+            record[field] = value
+
+    def set_item(self, test_ident, field, key, value):
+        """Sets ``key`` of a dict field (``statuses``, ``durations``, ...) of a test's record"""
+        if self.journal is not None:
+            self.journal.append("artifact", "set_item", (test_ident, field, key, value), {})
+        record = self.record(test_ident)
+        with self._lock:
+            container = record.get(field)
+            if container is None:
+                record[field] = container = {}
+        container[sys.intern(key) if isinstance(key, str) else key] = value
+
+    def add_file(self, test_ident, file_dict):
+        """Appends the description of a dumped file to the ``files`` of a test's record"""
+        if self.journal is not None:
+            self.journal.append("artifact", "add_file", (test_ident, file_dict), {})
+        record = self.record(test_ident)
+        with self._lock:
+            files = record.get("files")
+            if files is None:
+                record["files"] = files = []
+        files.append(file_dict)
+
+    def __getitem__(self, test_ident):
+        return self._records[test_ident]
+
+    def __setitem__(self, test_ident, record):
+        if not isinstance(record, TestRecord):
+            record = TestRecord(record)
+        self._records[sys.intern(test_ident)] = record
+
+    def __delitem__(self, test_ident):
+        del self._records[test_ident]
+
+    def __contains__(self, test_ident):
+        return test_ident in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({len(self)} tests)"
+
+    def __getstate__(self):
+        return self._records
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._records.update(state)
+
+
+def plain_artifacts(artifacts):
+    """
+    Returns a copy of ``artifacts``, an ArtifactStore or a dict of records, made of plain dicts,
+    as it is sent back to clients grabbing the result of an event
+    """
+    if isinstance(artifacts, ArtifactStore):
+        artifacts = artifacts._records
+    return {ident: copy.deepcopy(dict(record)) for ident, record in list(artifacts.items())}
@@ -1,5 +1,16 @@
+import gzip
 import re
 import socket
+import sys
+from functools import lru_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffixes of compressed artifacts by compression method
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
 
 
 def net_check(port, addr=None):
@@ -19,42 +30,72 @@ def net_check(port, addr=None):
         return False
 
 
+@lru_cache(maxsize=1 << 17)
 def process_pytest_path(path):
-    # Processes the path elements with regards to []
-    path = path.lstrip("/")
-    if len(path) == 0:
-        return []
-    try:
-        seg_end = path.index("/")
-    except ValueError:
-        seg_end = None
-    try:
-        param_start = path.index("[")
-    except ValueError:
-        param_start = None
-    try:
-        param_end = path.index("]")
-    except ValueError:
-        param_end = None
-    if seg_end is None:
-        # Definitely a final segment
-        return [path]
-    else:
-        if (
-            param_start is not None
-            and param_end is not None
-            and seg_end > param_start
-            and seg_end < param_end
-        ):
+    """Splits a pytest node path into its segments, with regards to []
+
+    A / between the first [ and the first ] that follow the start of a segment does not end
+    the segment, it ends at that ] instead. The path is scanned once, and the segments are
+    returned as a tuple of interned strings, cached for the paths seen last.
+    """
+    segments = []
+    end = len(path)
+    pos = 0
+    # the next [ and ] at or after pos, end if there is none
+    param_start = param_end = -1
+    while True:
+        while pos < end and path[pos] == "/":
+            pos += 1
+        if pos == end:
+            break
+        seg_end = path.find("/", pos)
+        if seg_end == -1:
+            # Definitely a final segment
+            segments.append(sys.intern(path[pos:]))
+            break
+        if param_start < pos:
+            param_start = path.find("[", pos)
+            param_start = end if param_start == -1 else param_start
+        if param_end < pos:
+            param_end = path.find("]", pos)
+            param_end = end if param_end == -1 else param_end
+        if param_start < seg_end < param_end < end:
             # The / inside []
-            segment = path[: param_end + 1]
-            rest = path[param_end + 1 :]
-            return [segment] + process_pytest_path(rest)
+            segments.append(sys.intern(path[pos : param_end + 1]))
+            pos = param_end + 1
         else:
             # The / that is not inside []
-            segment = path[:seg_end]
-            rest = path[seg_end + 1 :]
-            return [segment] + process_pytest_path(rest)
+            segments.append(sys.intern(path[pos:seg_end]))
+            pos = seg_end + 1
+    return tuple(segments)
+
+
+def open_artifact(filename, mode="r", **kwargs):
+    """Opens an artifact, transparently (de)compressing it if its name ends in .gz or .zst
+
+    Text modes work like they do with ``open``, kwargs like ``encoding`` or ``newline`` are
+    passed on.
+    """
+    if filename.endswith(".gz"):
+        if "b" not in mode and "t" not in mode:
+            mode += "t"
+        return gzip.open(filename, mode, **kwargs)
+    elif filename.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is needed to open {filename}")
+        return zstandard.open(filename, mode, **kwargs)
+    return open(filename, mode, **kwargs)
+
+
+def compress(data, method):
+    """Compresses bytes with gzip or zstd, the same data always compresses the same"""
+    if method == "gzip":
+        return gzip.compress(data, mtime=0)
+    elif method == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed for zstd compression")
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression {method}")
 
 
 def safe_string(o):
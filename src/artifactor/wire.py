@@ -0,0 +1,100 @@
+"""
+Wire format of the one-way channel
+
+A message is sent as a multipart ZMQ message::
+
+    [serializer, header, payload, payload, ...]
+
+``serializer`` names how the header is encoded, ``json`` or, if installed, ``msgpack``.
+Binary hook arguments (``contents`` of a filedump) are taken out of the header and travel
+as raw frames of their own, the header only records which frame belongs to which argument.
+The receiving side gets them back as memoryviews of the received frames, so they can be
+written to disk without being decoded or copied.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Hook arguments that may carry large binary payloads
+PAYLOAD_ARGS = frozenset({"contents"})
+BINARY = (bytes, bytearray, memoryview)
+
+# The key under which a header maps payload arguments to frame indices
+FRAMES_KEY = "_frames"
+
+
+def _dump_json(obj):
+    return json.dumps(obj).encode("utf-8")
+
+
+def _load_json(data):
+    return json.loads(bytes(data).decode("utf-8"))
+
+
+def _dump_msgpack(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _load_msgpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = {b"json": (_dump_json, _load_json), b"msgpack": (_dump_msgpack, _load_msgpack)}
+
+
+def default_serializer():
+    return "msgpack" if msgpack is not None else "json"
+
+
+def _split(data, payloads):
+    frames = {}
+    for key in PAYLOAD_ARGS:
+        if isinstance(data.get(key), BINARY):
+            frames[key] = len(payloads)
+            payloads.append(data[key])
+    if not frames:
+        return data
+    data = {k: v for k, v in data.items() if k not in frames}
+    data[FRAMES_KEY] = frames
+    return data
+
+
+def _join(data, payloads):
+    frames = data.pop(FRAMES_KEY, None)
+    if frames:
+        for key, index in frames.items():
+            data[key] = payloads[index]
+    return data
+
+
+def encode(message, serializer="json"):
+    """Returns the frames of a message, a dict with the hook_name and the data of the hook
+
+    Payloads of the events of a batch are taken out of band as well.
+    """
+    payloads = []
+    data = _split(message["data"], payloads)
+    if "events" in data:
+        data = dict(
+            data,
+            events=[dict(event, data=_split(event["data"], payloads)) for event in data["events"]],
+        )
+    message = dict(message, data=data)
+    name = serializer.encode("ascii")
+    dump, _ = SERIALIZERS[name]
+    return [name, dump(message)] + payloads
+
+
+def decode(frames):
+    """Rebuilds a message from frames as received with ``recv_multipart(copy=False)``"""
+    name, header, *payloads = frames
+    _, load = SERIALIZERS[name.bytes]
+    payloads = [frame.buffer for frame in payloads]
+    message = load(header.buffer)
+    data = _join(message["data"], payloads)
+    for event in data.get("events", ()):
+        _join(event["data"], payloads)
+    return message